@@ -0,0 +1,50 @@
+from decimal import Decimal
+from django.conf import settings
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def _get_exponents():
+    return dict(settings.CURRENCY_PLACES)
+
+
+def get_exponent(currency):
+    """
+    Returns the number of decimal places of a currency, as used by the paygate for
+    amounts in minor units.
+    """
+    return _get_exponents().get(currency, 2)
+
+
+def to_minor_units(amount, currency):
+    """
+    Converts a decimal amount into an integer number of minor units.
+
+    The conversion only shifts the decimal point and never goes through a float.
+    Fractions of a minor unit are truncated.
+    """
+    return int(Decimal(amount).scaleb(get_exponent(currency)))
+
+
+def from_minor_units(value, currency):
+    """
+    Converts an integer number of minor units into a decimal amount with exactly
+    the currency's number of decimal places.
+    """
+    return Decimal(int(value)).scaleb(-get_exponent(currency))
+
+
+def to_minor_units_many(amounts, currency):
+    """
+    Bulk variant of ``to_minor_units`` for reconciliation and export jobs.
+    """
+    exponent = get_exponent(currency)
+    return [int(Decimal(a).scaleb(exponent)) for a in amounts]
+
+
+def from_minor_units_many(values, currency):
+    """
+    Bulk variant of ``from_minor_units`` for reconciliation and export jobs.
+    """
+    exponent = -get_exponent(currency)
+    return [Decimal(int(v)).scaleb(exponent) for v in values]
@@ -26,3 +26,6 @@ class PluginApp(PluginConfig):
 
     def ready(self):
         from . import signals  # NOQA
+        from .codes import check_catalogue
+
+        check_catalogue()
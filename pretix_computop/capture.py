@@ -0,0 +1,147 @@
+import logging
+import requests
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from django.db import connection, transaction
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderPayment
+from pretix.base.payment import PaymentException
+from pretix.helpers import OF_SELF
+
+from .codes import ACTION_CONFIRM, ACTION_FAIL, get_result_code
+from .paymentmethods import get_provider_identifiers
+from .response import load_info
+
+logger = logging.getLogger("pretix_computop")
+
+BRANDS = ("computop", "firstcash")
+
+
+class RateLimiter:
+    """
+    Spaces out calls to at most ``rate`` per second, shared by all threads.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            slot = max(self.next_slot, time.monotonic())
+            self.next_slot = slot + self.interval
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def get_authorized_payments(methods=("CC", "EDD")):
+    """
+    Returns the pending payments of the given methods, which includes the ones that
+    have been authorized with manual capture and still wait for their capture.
+
+    The selection only uses indexed columns, whether a payment is actually waiting
+    for its capture is checked by ``capture_payment`` under a lock.
+    """
+    identifiers = [
+        i for brand in BRANDS for i in get_provider_identifiers(brand, methods)
+    ]
+    return OrderPayment.objects.filter(
+        provider__in=identifiers,
+        state=OrderPayment.PAYMENT_STATE_PENDING,
+    )
+
+
+def _lock(payment_id):
+    return (
+        OrderPayment.objects.select_for_update(of=OF_SELF)
+        .select_related("order", "order__event")
+        .get(pk=payment_id)
+    )
+
+
+def capture_payment(payment_id, get_limiter, url=None, retry_requested=False):
+    """
+    Captures a single authorized payment.
+
+    Before the capture is sent, the payment is marked as requested. If the process is
+    interrupted before the response has been processed, the payment is not captured
+    again unless ``retry_requested`` is set, as it may already have been captured by
+    the paygate. A transient reply leaves the payment authorized, so a later run
+    tries again.
+    """
+    with scopes_disabled():
+        with transaction.atomic():
+            payment = _lock(payment_id)
+            info = load_info(payment)
+            if (
+                payment.state != OrderPayment.PAYMENT_STATE_PENDING
+                or info.get("Status") != "AUTHORIZED"
+            ):
+                return "skipped"
+            if info.get("CaptureRequested") and not retry_requested:
+                return "unconfirmed"
+            payment.info_data = dict(info, CaptureRequested=now().isoformat())
+            payment.save(update_fields=["info"])
+
+        pprov = payment.payment_provider
+        get_limiter(pprov.settings.get("merchant_id")).wait()
+        try:
+            response = pprov.execute_capture(payment, url)
+        except (requests.RequestException, KeyError, PaymentException):
+            logger.exception("Could not capture payment %s", payment.full_id)
+            return "error"
+
+        action = get_result_code(response.get("Code", "")).action
+        with transaction.atomic():
+            payment = _lock(payment_id)
+            if action in (ACTION_CONFIRM, ACTION_FAIL):
+                pprov.process_result(payment, response, "capture")
+            else:
+                payment.order.log_action(
+                    "pretix_computop.event",
+                    data={"source": "capture", "data": response.to_dict()},
+                )
+                info = dict(load_info(payment), CaptureCode=response.get("Code"))
+                info.pop("CaptureRequested", None)
+                payment.info_data = info
+                payment.save(update_fields=["info"])
+
+    if action == ACTION_CONFIRM:
+        return "captured"
+    elif action == ACTION_FAIL:
+        return "failed"
+    return "transient"
+
+
+def capture_payments(
+    payment_ids, workers=8, rate=10.0, url=None, retry_requested=False
+):
+    """
+    Captures the given payments concurrently, limited to ``rate`` captures per second
+    and merchant account. Returns a counter of the outcomes.
+    """
+    limiters = defaultdict(lambda: RateLimiter(rate))
+    limiters_lock = threading.Lock()
+
+    def get_limiter(merchant_id):
+        with limiters_lock:
+            return limiters[merchant_id]
+
+    def work(payment_id):
+        try:
+            return capture_payment(payment_id, get_limiter, url, retry_requested)
+        except Exception:
+            logger.exception("Could not capture payment %s", payment_id)
+            return "error"
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return Counter(executor.map(work, payment_ids))
@@ -0,0 +1,130 @@
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from django.db import transaction
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderRefund
+from pretix.helpers import OF_SELF
+
+from .capture import BRANDS
+from .codes import ACTION_FAIL, CATEGORY_DECLINED, get_result_code
+from .paymentmethods import get_provider_identifiers
+from .response import INFO_VERSION, load_info
+
+logger = logging.getLogger("pretix_computop")
+
+
+def get_queued_refunds():
+    identifiers = [i for brand in BRANDS for i in get_provider_identifiers(brand)]
+    return OrderRefund.objects.filter(
+        provider__in=identifiers,
+        state=OrderRefund.REFUND_STATE_TRANSIT,
+        info__contains="Coalesce",
+    )
+
+
+def flush_queued_refunds(force=False):
+    """
+    Sends the queued partial refunds of every payment whose oldest queued refund is
+    older than the configured coalescing window.
+    """
+    with scopes_disabled():
+        groups = defaultdict(list)
+        for refund in get_queued_refunds().select_related("payment__order__event"):
+            groups[refund.payment].append(refund)
+
+        for payment, refunds in groups.items():
+            pprov = payment.payment_provider
+            window = timedelta(minutes=pprov.refund_coalesce_window)
+            if not force and min(r.created for r in refunds) > now() - window:
+                continue
+            try:
+                flush_refunds(pprov, [r.pk for r in refunds])
+            except Exception:
+                logger.exception(
+                    "Could not send queued refunds of payment %s", payment.full_id
+                )
+
+
+def flush_refunds(pprov, refund_ids):
+    with transaction.atomic():
+        refunds = [
+            r
+            for r in OrderRefund.objects.select_for_update(of=OF_SELF)
+            .select_related("order", "payment")
+            .filter(pk__in=refund_ids, state=OrderRefund.REFUND_STATE_TRANSIT)
+            .order_by("pk")
+            if load_info(r).get("Coalesce")
+        ]
+        # Mark the refunds as sent before talking to the paygate, so a crash
+        # afterwards can never lead to the same refund being sent twice.
+        for r in refunds:
+            r.info_data = {
+                "_v": INFO_VERSION,
+                "PayID": load_info(r).get("PayID"),
+                "Description": "Refund sent, waiting for the result",
+            }
+            r.save(update_fields=["info"])
+
+    if not refunds:
+        return
+
+    if len(refunds) > 1:
+        try:
+            response = pprov.execute_coalesced_refund(refunds)
+        except Exception as e:
+            # Without a response, the paygate may still have executed the combined
+            # credit. Sending the refunds again could pay the customer twice, so
+            # they are left for a manual check.
+            logger.exception("Combined refund of %d refunds failed", len(refunds))
+            with transaction.atomic():
+                for r in _lock(refunds):
+                    _fail(r, e)
+            return
+
+        result = get_result_code(response.get("Code", ""))
+        # A decline applies to the individual refunds just as well, only errors
+        # reported for the combined request are worth sending them one by one.
+        if result.action != ACTION_FAIL or result.category == CATEGORY_DECLINED:
+            with transaction.atomic():
+                for r in _lock(refunds):
+                    pprov.process_result(r, response)
+            return
+        logger.info(
+            "Combined refund of %d refunds failed with code %s, sending them one by one",
+            len(refunds),
+            response.get("Code"),
+        )
+
+    for r in refunds:
+        try:
+            response = pprov._send_credit(pprov._get_refund_data(r))
+        except Exception as e:
+            logger.exception("Could not send refund %s", r.full_id)
+            with transaction.atomic():
+                _fail(_lock([r])[0], e)
+            continue
+        with transaction.atomic():
+            pprov.process_result(_lock([r])[0], response)
+
+
+def _fail(refund, exc):
+    refund.state = OrderRefund.REFUND_STATE_FAILED
+    refund.execution_date = now()
+    refund.info_data = {
+        "_v": INFO_VERSION,
+        "PayID": load_info(refund).get("PayID"),
+        "Description": "Refund request failed without a result ({}), please check "
+        "in the payment provider's backend whether it has been executed".format(exc),
+    }
+    refund.save(update_fields=["state", "execution_date", "info"])
+
+
+def _lock(refunds):
+    return list(
+        OrderRefund.objects.select_for_update(of=OF_SELF)
+        .select_related("order", "payment")
+        .filter(pk__in=[r.pk for r in refunds])
+        .order_by("pk")
+    )
@@ -0,0 +1,148 @@
+import json
+import os
+from collections import namedtuple
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.translation import gettext_lazy as _
+from functools import lru_cache
+
+ACTION_CONFIRM = "confirm"
+ACTION_FAIL = "fail"
+ACTION_PENDING = "pending"
+
+CATEGORY_OK = "ok"
+CATEGORY_ERROR = "error"
+# The customer's bank or card issuer refused the transaction, sending the same
+# request again won't change the result.
+CATEGORY_DECLINED = "declined"
+CATEGORY_FATAL = "fatal"
+CATEGORY_TRANSIENT = "transient"
+CATEGORY_3DS = "3ds"
+
+# What a result of each category means for the payment, and the message shown to
+# the customer. Catalogue entries only pick a category, so every text a customer
+# can see is translated.
+CATEGORIES = {
+    CATEGORY_OK: (
+        ACTION_CONFIRM,
+        _("The payment has been processed successfully."),
+    ),
+    CATEGORY_ERROR: (
+        ACTION_FAIL,
+        _(
+            "The payment could not be processed. Please try again or choose a different payment method."
+        ),
+    ),
+    CATEGORY_DECLINED: (
+        ACTION_FAIL,
+        _(
+            "The payment has been declined by your bank or card issuer. Please choose a different payment "
+            "method."
+        ),
+    ),
+    CATEGORY_FATAL: (
+        ACTION_FAIL,
+        _(
+            "The payment could not be processed. Please choose a different payment method or contact "
+            "the event organizer."
+        ),
+    ),
+    CATEGORY_TRANSIENT: (
+        ACTION_PENDING,
+        _("The payment is still being processed by the payment provider."),
+    ),
+    CATEGORY_3DS: (
+        ACTION_PENDING,
+        _("The payment is waiting for the authentication of the card holder."),
+    ),
+}
+
+ResultCode = namedtuple(
+    "ResultCode",
+    ("code", "category", "retryable", "message", "action", "description"),
+)
+
+
+def make_result_code(code, category, retryable, description=""):
+    action, message = CATEGORIES[category]
+    return ResultCode(code, category, retryable, message, action, description)
+
+
+# Paygate result codes consist of eight digits: the severity, a three digit category
+# and a four digit detail. Specific results are described by the catalogue shipped in
+# result_codes.json, which can be extended with entries from Computop's code list
+# through the result_codes_file option in the [computop] section of the pretix
+# config. Catalogue entries have either all eight digits or the four digits of
+# severity and category.
+CATALOGUE_FILE = os.path.join(os.path.dirname(__file__), "result_codes.json")
+
+# Results that are not in the catalogue are classified by their severity only
+RESULT_CODES = (
+    make_result_code("0", CATEGORY_OK, False),
+    make_result_code("2", CATEGORY_ERROR, True),
+    make_result_code("4", CATEGORY_FATAL, False),
+    make_result_code("6", CATEGORY_TRANSIENT, True),
+    make_result_code("7", CATEGORY_3DS, True),
+)
+
+UNKNOWN_RESULT = ResultCode(
+    "",
+    "unknown",
+    False,
+    _("The payment provider reported an unknown result."),
+    ACTION_FAIL,
+    "",
+)
+
+
+def _load_catalogue(filename):
+    try:
+        with open(filename, encoding="utf-8") as f:
+            entries = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ImproperlyConfigured(
+            "Could not read the result code catalogue {}: {}".format(filename, e)
+        )
+    for entry in entries:
+        code = entry.get("code", "")
+        if (
+            len(code) not in (4, 8)
+            or not code.isdigit()
+            or entry.get("category") not in CATEGORIES
+            or not isinstance(entry.get("retryable"), bool)
+            or (entry["category"] == CATEGORY_DECLINED and entry["retryable"])
+        ):
+            raise ImproperlyConfigured(
+                "Invalid result code entry {!r} in {}".format(entry, filename)
+            )
+        yield make_result_code(
+            code, entry["category"], entry["retryable"], entry.get("description", "")
+        )
+
+
+@lru_cache(maxsize=None)
+def _get_index():
+    index = {r.code: r for r in RESULT_CODES}
+    filenames = [CATALOGUE_FILE]
+    if settings.CONFIG_FILE.has_option("computop", "result_codes_file"):
+        filenames.append(settings.CONFIG_FILE.get("computop", "result_codes_file"))
+    for filename in filenames:
+        index.update((r.code, r) for r in _load_catalogue(filename))
+    return index
+
+
+def check_catalogue():
+    """
+    Loads the result code catalogue, so a broken catalogue stops pretix from
+    starting instead of failing the first callback.
+    """
+    _get_index()
+
+
+def get_result_code(code):
+    """
+    Looks up a result by its full code, then by its severity and category and
+    finally by its severity alone.
+    """
+    index = _get_index()
+    return index.get(code) or index.get(code[:4]) or index.get(code[:1], UNKNOWN_RESULT)
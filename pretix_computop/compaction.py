@@ -0,0 +1,50 @@
+import logging
+import time
+from django.db import transaction
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderPayment, OrderRefund
+from pretix.helpers import OF_SELF
+
+from .capture import BRANDS
+from .paymentmethods import get_provider_identifiers
+from .response import INFO_VERSION, compact_info
+
+logger = logging.getLogger("pretix_computop")
+
+
+def compact_stored_info(batch_size=1000):
+    """
+    Rewrites the info of payments and refunds that still contain the full paygate
+    response into the compact layout, in batches of ``batch_size``. Each batch is
+    locked, so a callback arriving meanwhile can't be overwritten. Returns the number
+    of rewritten rows and the elapsed time.
+    """
+    identifiers = [i for brand in BRANDS for i in get_provider_identifiers(brand)]
+    compacted = 0
+    started = time.monotonic()
+
+    with scopes_disabled():
+        for model in (OrderPayment, OrderRefund):
+            last_pk = 0
+            while True:
+                with transaction.atomic():
+                    rows = list(
+                        model.objects.select_for_update(of=OF_SELF)
+                        .filter(provider__in=identifiers, pk__gt=last_pk)
+                        .exclude(info__contains='"_v"')
+                        .order_by("pk")
+                        .only("pk", "info")[:batch_size]
+                    )
+                    if not rows:
+                        break
+                    last_pk = rows[-1].pk
+                    for row in rows:
+                        info = row.info_data
+                        if info.get("_v") != INFO_VERSION:
+                            row.info_data = compact_info(info)
+                    model.objects.bulk_update(rows, ["info"])
+                    compacted += len(rows)
+
+    elapsed = time.monotonic() - started
+    logger.info("Compacted the info of %d rows in %.2fs", compacted, elapsed)
+    return compacted, elapsed
@@ -0,0 +1,158 @@
+import logging
+import requests
+import threading
+import time
+from django.conf import settings
+from functools import lru_cache
+from pretix.base.metrics import Counter
+
+logger = logging.getLogger("pretix_computop")
+
+DEFAULT_ENDPOINT = "https://www.computop-paygate.com/"
+# Timeout of server-to-server requests in seconds, unless the caller passes its own
+REQUEST_TIMEOUT = 30
+
+pretix_computop_endpoint_failovers_total = Counter(
+    "pretix_computop_endpoint_failovers_total",
+    "Number of times a different paygate endpoint has been selected.",
+    ["brand", "endpoint"],
+)
+pretix_computop_endpoint_errors_total = Counter(
+    "pretix_computop_endpoint_errors_total",
+    "Number of failed requests to a paygate endpoint.",
+    ["brand", "endpoint"],
+)
+
+
+class Endpoint:
+    __slots__ = ("url", "latency", "healthy")
+
+    def __init__(self, url):
+        self.url = url
+        self.latency = None
+        self.healthy = True
+
+
+class EndpointPool:
+    """
+    Picks the healthy paygate endpoint with the lowest latency.
+
+    Latencies are tracked as an exponentially weighted moving average of real
+    requests and of health probes. Probes run in a background thread whenever a
+    selection happens and the last probe is older than ``probe_interval``. With a
+    single endpoint, nothing is tracked or probed.
+    """
+
+    def __init__(self, brand, urls, alpha=0.3, probe_interval=30, probe_timeout=5):
+        self.brand = brand
+        self.endpoints = [Endpoint(u if u.endswith("/") else u + "/") for u in urls]
+        self.alpha = alpha
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.selected = self.endpoints[0]
+        self.last_probe = 0
+        self.lock = threading.Lock()
+
+    def select(self):
+        """
+        Returns the URL of the endpoint to use. Called concurrently by all threads
+        of a worker, so the endpoint state is only read and changed under the lock.
+        """
+        if len(self.endpoints) == 1:
+            return self.selected.url
+
+        self._maybe_probe()
+        with self.lock:
+            healthy = [e for e in self.endpoints if e.healthy]
+            if healthy:
+                # Endpoints without a measurement yet are tried in configured order
+                best = min(
+                    healthy,
+                    key=lambda e: (e.latency is not None, e.latency or 0),
+                )
+            else:
+                best = self.endpoints[0]
+
+            if best is not self.selected:
+                logger.warning(
+                    "Switching %s paygate endpoint from %s to %s",
+                    self.brand,
+                    self.selected.url,
+                    best.url,
+                )
+                pretix_computop_endpoint_failovers_total.inc(
+                    1, brand=self.brand, endpoint=best.url
+                )
+                self.selected = best
+            return best.url
+
+    def report(self, url, latency=None, error=False):
+        endpoint = next((e for e in self.endpoints if e.url == url), None)
+        if endpoint is None:
+            return
+        # Requests and probes report from different threads
+        with self.lock:
+            if error:
+                endpoint.healthy = False
+            else:
+                endpoint.healthy = True
+                if endpoint.latency is None:
+                    endpoint.latency = latency
+                else:
+                    endpoint.latency = (
+                        self.alpha * latency + (1 - self.alpha) * endpoint.latency
+                    )
+        if error:
+            pretix_computop_endpoint_errors_total.inc(
+                1, brand=self.brand, endpoint=url
+            )
+
+    def probe(self):
+        for endpoint in self.endpoints:
+            started = time.monotonic()
+            try:
+                r = requests.head(endpoint.url, timeout=self.probe_timeout)
+                error = r.status_code >= 500
+            except requests.RequestException:
+                error = True
+            self.report(endpoint.url, time.monotonic() - started, error)
+
+    def _maybe_probe(self):
+        with self.lock:
+            if time.monotonic() - self.last_probe < self.probe_interval:
+                return
+            self.last_probe = time.monotonic()
+        threading.Thread(target=self.probe, daemon=True).start()
+
+    def post(self, path, **kwargs):
+        """
+        Sends a server-to-server request to the selected endpoint. Failed requests
+        are not retried on another endpoint, as the paygate may already have
+        executed them, but the next request will avoid the failing endpoint.
+        """
+        kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+        url = self.select()
+        started = time.monotonic()
+        try:
+            r = requests.post(url + path, **kwargs)
+        except requests.RequestException:
+            self.report(url, error=True)
+            raise
+        self.report(url, time.monotonic() - started, r.status_code >= 500)
+        return r
+
+
+@lru_cache(maxsize=None)
+def get_endpoint_pool(brand):
+    """
+    Returns the endpoint pool of a brand, configured in the pretix config file as
+    ``endpoints_<brand>`` or ``endpoints`` in the ``[computop]`` section.
+    """
+    urls = settings.CONFIG_FILE.get(
+        "computop",
+        "endpoints_{}".format(brand),
+        fallback=settings.CONFIG_FILE.get(
+            "computop", "endpoints", fallback=DEFAULT_ENDPOINT
+        ),
+    ).split()
+    return EndpointPool(brand, urls)
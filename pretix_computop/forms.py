@@ -0,0 +1,11 @@
+from pretix.base.forms import SettingsForm
+
+from .payment import get_credential_fields
+
+
+class OrganizerSettingsForm(SettingsForm):
+    def __init__(self, *args, **kwargs):
+        brand = kwargs.pop("brand")
+        super().__init__(*args, **kwargs)
+        for name, field in get_credential_fields(required=False):
+            self.fields["payment_{}_{}".format(brand, name)] = field
@@ -0,0 +1,76 @@
+import datetime
+import time
+from django.core.management.base import BaseCommand
+from django_scopes import scopes_disabled
+
+from pretix_computop.capture import capture_payments, get_authorized_payments
+from pretix_computop.routing import get_read_db
+
+
+class Command(BaseCommand):
+    help = "Captures Computop payments that have been authorized with manual capture."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--organizer", help="Only capture payments of this organizer.")
+        parser.add_argument("--event", help="Only capture payments of this event.")
+        parser.add_argument(
+            "--method",
+            action="append",
+            choices=("CC", "EDD"),
+            help="Only capture payments of this payment method, e.g. EDD to submit all "
+            "collected SEPA direct debits. Can be given multiple times.",
+        )
+        parser.add_argument(
+            "--created-before",
+            type=datetime.date.fromisoformat,
+            help="Only capture payments created before this date (YYYY-MM-DD).",
+        )
+        parser.add_argument("--workers", type=int, default=8)
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=10.0,
+            help="Maximum number of captures per second and merchant account.",
+        )
+        parser.add_argument(
+            "--paygate-url",
+            help="Send the capture requests to this URL, e.g. a local paygate stand-in.",
+        )
+        parser.add_argument(
+            "--retry-requested",
+            action="store_true",
+            help="Also capture payments for which a previous run sent a capture without "
+            "receiving a response.",
+        )
+
+    def handle(self, *args, **options):
+        with scopes_disabled():
+            # Every payment is checked again under a lock before it is captured
+            qs = get_authorized_payments(
+                tuple(options["method"]) if options["method"] else ("CC", "EDD")
+            ).using(get_read_db())
+            if options["created_before"]:
+                qs = qs.filter(created__date__lt=options["created_before"])
+            if options["organizer"]:
+                qs = qs.filter(order__event__organizer__slug=options["organizer"])
+            if options["event"]:
+                qs = qs.filter(order__event__slug=options["event"])
+            payment_ids = list(qs.order_by("pk").values_list("pk", flat=True))
+
+        started = time.monotonic()
+        outcomes = capture_payments(
+            payment_ids,
+            workers=options["workers"],
+            rate=options["rate"],
+            url=options["paygate_url"],
+            retry_requested=options["retry_requested"],
+        )
+        elapsed = time.monotonic() - started
+
+        self.stdout.write(
+            "Processed {} payments in {:.2f}s ({:.1f}/s)".format(
+                len(payment_ids), elapsed, len(payment_ids) / elapsed if elapsed else 0
+            )
+        )
+        for outcome, count in outcomes.most_common():
+            self.stdout.write("  {}: {}".format(outcome, count))
@@ -0,0 +1,127 @@
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Q
+from django_scopes import scopes_disabled
+from pretix.base.models import Event
+
+from pretix_computop.capture import BRANDS
+from pretix_computop.response import ComputopResponse
+from pretix_computop.routing import get_read_db
+
+
+def check_credentials(pprov):
+    """
+    Runs a local encrypt/decrypt and HMAC round trip with the credentials of a
+    provider, through the same methods used for real payments. Returns an error
+    message or None.
+    """
+    merchant_id = pprov.settings.get("merchant_id")
+    if not merchant_id:
+        return "Merchant ID missing"
+    if not pprov.settings.get("blowfish_password"):
+        return "Encryption key missing"
+    if not pprov.settings.get("hmac_password"):
+        return "HMAC key missing"
+
+    plaintext = "MerchantID={}&TransID=check&Amount=100&Currency=EUR".format(
+        merchant_id
+    )
+    try:
+        ciphertext, length = pprov._encrypt(plaintext)
+        if length != len(plaintext) or pprov._decrypt(ciphertext) != plaintext:
+            return "Encryption round trip failed"
+    except Exception as e:
+        return "Invalid encryption key: {}".format(e)
+
+    response = ComputopResponse(
+        mid=merchant_id,
+        PayID="0",
+        TransID="check",
+        Status="OK",
+        Code="00000000",
+        MAC=pprov._calculate_hmac("0", "check", "OK", "00000000"),
+    )
+    if not pprov.check_hash(response):
+        return "HMAC round trip failed"
+
+
+class Command(BaseCommand):
+    help = (
+        "Checks the Computop and First Cash Solution credentials of all events and "
+        "warms the settings cache."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=8)
+
+    def handle(self, *args, **options):
+        with scopes_disabled():
+            events = list(
+                Event.objects.using(get_read_db())
+                .filter(
+                    Q(plugins__contains="pretix_computop")
+                    | Q(plugins__contains="pretix_firstcash")
+                )
+                .select_related("organizer")
+            )
+
+        # Events often share a merchant account, every distinct set of
+        # credentials only needs to be checked once.
+        results = {}
+
+        def check_event(event):
+            problems = []
+            try:
+                with scopes_disabled():
+                    providers = event.get_payment_providers()
+                    for brand in BRANDS:
+                        if "pretix_{}".format(brand) not in event.get_plugins():
+                            continue
+                        if not providers["{}_settings".format(brand)].settings.get(
+                            "_enabled", as_type=bool
+                        ):
+                            continue
+                        pprov = next(
+                            p
+                            for p in providers.values()
+                            if p.identifier.startswith(brand + "_") and not p.is_meta
+                        )
+                        credentials = (
+                            pprov.settings.get("merchant_id"),
+                            pprov.settings.get("blowfish_password"),
+                            pprov.settings.get("hmac_password"),
+                        )
+                        if credentials not in results:
+                            results[credentials] = check_credentials(pprov)
+                        if results[credentials]:
+                            problems.append((brand, results[credentials]))
+            except Exception as e:
+                problems.append(("-", "Could not check: {}".format(e)))
+            finally:
+                connection.close()
+            return event, problems
+
+        started = time.monotonic()
+        broken = defaultdict(list)
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            for event, problems in executor.map(check_event, events):
+                for brand, problem in problems:
+                    broken[problem].append(
+                        "{}/{} ({})".format(event.organizer.slug, event.slug, brand)
+                    )
+        elapsed = time.monotonic() - started
+
+        self.stdout.write(
+            "Checked {} events with {} distinct credentials in {:.2f}s".format(
+                len(events), len(results), elapsed
+            )
+        )
+        if not broken:
+            self.stdout.write("No problems found.")
+        for problem, event_names in sorted(broken.items()):
+            self.stdout.write("{} ({} events):".format(problem, len(event_names)))
+            for name in sorted(event_names):
+                self.stdout.write("  {}".format(name))
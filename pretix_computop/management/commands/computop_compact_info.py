@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from pretix_computop.compaction import compact_stored_info
+
+
+class Command(BaseCommand):
+    help = "Rewrites stored Computop payment and refund info into the compact layout."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        compacted, elapsed = compact_stored_info(batch_size=options["batch_size"])
+        self.stdout.write("Compacted {} rows in {:.2f}s".format(compacted, elapsed))
@@ -0,0 +1,27 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+
+from pretix_computop.sweeper import sweep_stale_payments
+
+
+class Command(BaseCommand):
+    help = "Cancels Computop payments that never returned from the paygate."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--hours",
+            type=int,
+            help="Minimum age of the payments, defaults to stale_payment_hours from the config.",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        swept, elapsed = sweep_stale_payments(
+            max_age=timedelta(hours=options["hours"]) if options["hours"] else None,
+            batch_size=options["batch_size"],
+        )
+        self.stdout.write(
+            "Canceled {} payments in {:.2f}s ({:.1f}/s)".format(
+                swept, elapsed, swept / elapsed if elapsed else 0
+            )
+        )
@@ -8,24 +8,82 @@ from collections import OrderedDict
 from Crypto.Cipher import Blowfish
 from Crypto.Hash import HMAC, SHA256
 from Crypto.Util import Padding
+from datetime import timedelta
 from decimal import Decimal
 from django import forms
-from django.conf import settings
 from django.http import HttpRequest
 from django.template.loader import get_template
+from django.utils.dateparse import parse_datetime
 from django.utils.safestring import mark_safe
 from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
-from pretix.base.decimal import round_decimal
+from functools import lru_cache
 from pretix.base.forms import SecretKeySettingsField
 from pretix.base.models import Event, Order, OrderPayment, OrderRefund
 from pretix.base.payment import BasePaymentProvider, PaymentException, WalletQueries
 from pretix.base.settings import SettingsSandbox
 from pretix.multidomain.urlreverse import build_absolute_uri
-from urllib.parse import parse_qsl, urlencode
+from urllib.parse import urlencode
+
+from .amounts import from_minor_units, to_minor_units
+from .codes import ACTION_CONFIRM, ACTION_FAIL, ACTION_PENDING, get_result_code
+from .endpoints import REQUEST_TIMEOUT, get_endpoint_pool
+from .profiling import profiled
+from .response import INFO_VERSION, ComputopResponse, compact_info, load_info
+from .routing import mark_written
 
 logger = logging.getLogger("pretix_computop")
 
+# How long the paygate request of a payment that has not been completed is reused
+# when the same payment is executed again.
+SESSION_REUSE_TIMEOUT = 600
+
+
+# Key-derived state is cached per credential instead of per event, so all events of
+# an organizer (or any other events sharing a merchant account) share it.
+@lru_cache(maxsize=128)
+def _get_cipher(key):
+    return Blowfish.new(key.encode("UTF-8"), Blowfish.MODE_ECB)
+
+
+@lru_cache(maxsize=128)
+def _get_hmac(secret):
+    return HMAC.new(secret.encode("UTF-8"), digestmod=SHA256)
+
+
+def get_credential_fields(required=True):
+    return [
+        (
+            "merchant_id",
+            forms.CharField(
+                label=_("Merchant ID"),
+                help_text=_("as sent to you by mail from your payment provider"),
+                required=required,
+                validators=(),
+            ),
+        ),
+        (
+            "blowfish_password",
+            SecretKeySettingsField(
+                label=_("Encryption key"),
+                help_text=_(
+                    "also called Blowfish-password, as sent to you by mail from your payment provider"
+                ),
+                required=required,
+                validators=(),
+            ),
+        ),
+        (
+            "hmac_password",
+            SecretKeySettingsField(
+                label=_("HMAC key"),
+                help_text=_("as sent to you by mail from your payment provider"),
+                required=required,
+                validators=(),
+            ),
+        ),
+    ]
+
 
 class ComputopSettingsHolder(BasePaymentProvider):
     identifier = "computop_settings"
@@ -40,37 +98,24 @@ class ComputopSettingsHolder(BasePaymentProvider):
 
     @property
     def settings_form_fields(self):
-        fields = [
-            (
-                "merchant_id",
-                forms.CharField(
-                    label=_("Merchant ID"),
-                    help_text=_("as sent to you by mail from your payment provider"),
-                    validators=(),
-                ),
-            ),
-            (
-                "blowfish_password",
-                SecretKeySettingsField(
-                    label=_("Encryption key"),
-                    help_text=_(
-                        "also called Blowfish-password, as sent to you by mail from your payment provider"
-                    ),
-                    validators=(),
-                ),
-            ),
-            (
-                "hmac_password",
-                SecretKeySettingsField(
-                    label=_("HMAC key"),
-                    help_text=_("as sent to you by mail from your payment provider"),
-                    validators=(),
-                ),
-            ),
-        ]
-
+        # Credentials set in the organizer settings are inherited by all events and
+        # prefilled here, changing them overrides them for this event only.
         d = OrderedDict(
-            fields
+            get_credential_fields()
+            + [
+                (
+                    "refund_coalesce_window",
+                    forms.IntegerField(
+                        label=_("Combine partial refunds"),
+                        help_text=_(
+                            "If set, partial refunds of the same payment that are created within this number of "
+                            "minutes are sent to the payment provider as a single refund."
+                        ),
+                        min_value=0,
+                        required=False,
+                    ),
+                )
+            ]
             + self.payment_methods_settingsholder
             + list(super().settings_form_fields.items())
         )
@@ -83,7 +128,7 @@ class ComputopMethod(BasePaymentProvider):
     method = ""
     verbose_name = ""
     retired = False
-    apiurl = "https://www.computop-paygate.com/paymentpage.aspx"
+    apipath = "paymentpage.aspx"
 
     def __init__(self, event: Event):
         super().__init__(event)
@@ -93,6 +138,16 @@ class ComputopMethod(BasePaymentProvider):
     def settings_form_fields(self):
         return {}
 
+    @property
+    def endpoint_pool(self):
+        return get_endpoint_pool(self.identifier.split("_")[0])
+
+    @property
+    def capture_manual(self) -> bool:
+        return self.settings.get(
+            "method_{}_capture_manual".format(self.method), False, as_type=bool
+        )
+
     @property
     def is_enabled(self) -> bool:
         if self.retired:
@@ -151,41 +206,76 @@ class ComputopMethod(BasePaymentProvider):
             )
         )
 
+    @profiled("execute_payment")
     def execute_payment(self, request: HttpRequest, payment: OrderPayment) -> str:
-        data = self._get_payment_data(payment)
-        encrypted_data = self._encrypt(urlencode(data, safe=":/"))
+        session = self._get_session(payment)
+        if not session:
+            data = self._get_payment_data(payment)
+            encrypted_data = self._encrypt(urlencode(data, safe=":/"))
+            session = {
+                "Data": encrypted_data[0],
+                "Len": encrypted_data[1],
+                "Created": now().isoformat(),
+            }
+            data["Description"] = "Payment process initiated but not completed"
+            info = compact_info(data)
+            info["Session"] = session
+            payment.info_data = info
+            payment.save(update_fields=["info"])
+            mark_written(payment.order)
+
         payload = {
             "MerchantID": self.settings.get("merchant_id"),
-            "Len": encrypted_data[1],
-            "Data": encrypted_data[0],
+            "Len": session["Len"],
+            "Data": session["Data"],
             "Language": payment.order.locale[:2],
         }
-        data["Description"] = "Payment process initiated but not completed"
-        payment.info_data = data
-        payment.save(update_fields=["info"])
-        return self.apiurl + "?" + urlencode(payload, safe="|")
+        return (
+            self.endpoint_pool.select()
+            + self.apipath
+            + "?"
+            + urlencode(payload, safe="|")
+        )
+
+    def _get_session(self, payment: OrderPayment):
+        """
+        pretix executes a payment again if the customer confirms it once more, e.g.
+        after coming back from the paygate without paying. Within
+        SESSION_REUSE_TIMEOUT, the encrypted request of the first attempt is sent
+        again instead of starting another paygate session.
+        """
+        session = load_info(payment).get("Session")
+        if not session or payment.state != OrderPayment.PAYMENT_STATE_CREATED:
+            return None
+        created = parse_datetime(session["Created"])
+        if created < now() - timedelta(seconds=SESSION_REUSE_TIMEOUT):
+            return None
+        return session
 
     def api_payment_details(self, payment: OrderPayment):
+        info = load_info(payment)
         return {
-            "id": payment.info_data.get("PayID", None),
-            "payment_method": payment.info_data.get("pt", None),
+            "id": info.get("PayID", None),
+            "payment_method": info.get("pt", None),
         }
 
     def matching_id(self, payment: OrderPayment):
-        return payment.info_data.get("PayID", None)
+        return load_info(payment).get("PayID", None)
 
     def refund_matching_id(self, refund: OrderRefund):
-        return refund.info_data.get("PayID", None)
+        return load_info(refund).get("PayID", None)
 
     def payment_control_render(
         self, request: HttpRequest, payment: OrderPayment
     ) -> str:
         template = get_template("pretix_computop/control.html")
+        info = load_info(payment)
         ctx = {
             "request": request,
             "event": self.event,
             "settings": self.settings,
-            "payment_info": payment.info_data,
+            "payment_info": info,
+            "result_code": get_result_code(info["Code"]) if "Code" in info else None,
             "payment": payment,
             "method": self.method,
             "provider": self,
@@ -193,7 +283,7 @@ class ComputopMethod(BasePaymentProvider):
         return template.render(ctx)
 
     def payment_control_render_short(self, payment: OrderPayment) -> str:
-        payment_info = payment.info_data
+        payment_info = load_info(payment)
         r = payment_info.get("PayID", "")
         if payment_info.get("pt"):
             if r:
@@ -215,9 +305,40 @@ class ComputopMethod(BasePaymentProvider):
             return True
         return False
 
+    @property
+    def refund_coalesce_window(self) -> int:
+        return self.settings.get("refund_coalesce_window", as_type=int, default=0) or 0
+
+    @profiled("execute_refund")
     def execute_refund(self, refund: OrderRefund):
+        # Partial refunds are queued and sent together by the periodic task
+        if self.refund_coalesce_window and refund.amount < refund.payment.amount:
+            refund.state = OrderRefund.REFUND_STATE_TRANSIT
+            refund.info_data = {
+                "_v": INFO_VERSION,
+                "PayID": load_info(refund.payment).get("PayID"),
+                "Description": "Queued to be combined with other partial refunds",
+                "Coalesce": True,
+            }
+            refund.save(update_fields=["state", "info"])
+            return
+
         data = self._get_refund_data(refund)
+        self.process_result(refund, self._send_credit(data))
+
+    def execute_coalesced_refund(self, refunds):
+        """
+        Sends a single credit request for several refunds of the same payment and
+        returns the paygate's response, to be processed for each of the refunds.
+        """
+        data = self._get_credit_data(
+            load_info(refunds[0].payment)["PayID"],
+            "{}-C".format(refunds[0].full_id),
+            sum(r.amount for r in refunds),
+        )
+        return self._send_credit(data)
 
+    def _send_credit(self, data):
         encrypted_data = self._encrypt(urlencode(data))
         payload = {
             "MerchantID": self.settings.get("merchant_id"),
@@ -225,14 +346,34 @@ class ComputopMethod(BasePaymentProvider):
             "Data": encrypted_data[0],
         }
 
-        req = requests.post(
-            "https://www.computop-paygate.com/credit.aspx",
-            data=payload,
-        )
+        req = self.endpoint_pool.post("credit.aspx", data=payload)
 
         parsed = urllib.parse.parse_qs(req.text)
-        processed = self.parse_data(parsed["Data"][0])
-        self.process_result(refund, processed)
+        return self.parse_data(parsed["Data"][0])
+
+    def execute_capture(self, payment: OrderPayment, url=None):
+        """
+        Captures an authorized payment and returns the paygate's response.
+
+        The payment itself is not changed, callers pass the response to
+        ``process_result`` while holding a lock on the payment.
+        """
+        data = self._get_capture_data(payment)
+
+        encrypted_data = self._encrypt(urlencode(data))
+        payload = {
+            "MerchantID": self.settings.get("merchant_id"),
+            "Len": encrypted_data[1],
+            "Data": encrypted_data[0],
+        }
+
+        if url:
+            req = requests.post(url, data=payload, timeout=REQUEST_TIMEOUT)
+        else:
+            req = self.endpoint_pool.post("capture.aspx", data=payload)
+
+        parsed = urllib.parse.parse_qs(req.text)
+        return self.parse_data(parsed["Data"][0])
 
     def refund_control_render(self, request: HttpRequest, refund: OrderRefund) -> str:
         return self.payment_control_render(request, refund)
@@ -251,43 +392,64 @@ class ComputopMethod(BasePaymentProvider):
         else:
             return False
 
-    def parse_data(self, data):
+    def parse_data(self, data) -> ComputopResponse:
         payload = self._decrypt(str(data))
-        return dict(parse_qsl(payload))
+        return ComputopResponse.parse(payload)
 
-    def process_result(self, payment_or_refund, data, datasource=None):
+    @profiled("process_result")
+    def process_result(
+        self, payment_or_refund, data, datasource=None, send_mail=True
+    ):
         if datasource:
             payment_or_refund.order.log_action(
-                "pretix_computop.event", data={"source": datasource, "data": data}
+                "pretix_computop.event",
+                data={"source": datasource, "data": data.to_dict()},
             )
 
+        result = get_result_code(data["Code"])
+        mark_written(payment_or_refund.order)
+
         if isinstance(payment_or_refund, OrderPayment):
             payment = payment_or_refund
-
-            # OK
-            if data["Code"][:1] == "0":
-                if payment.state not in (
+            # The capture mode the payment has been started with, the setting may
+            # have changed since then.
+            capture = load_info(payment).get("Capture")
+            info = data.to_info()
+            if capture:
+                info["Capture"] = capture
+
+            if result.action == ACTION_CONFIRM:
+                # Authorized only, the payment is confirmed once it has been captured
+                if (
+                    data.get("Status") == "AUTHORIZED"
+                    and capture == "MANUAL"
+                    and payment.state
+                    in (
+                        OrderPayment.PAYMENT_STATE_CREATED,
+                        OrderPayment.PAYMENT_STATE_PENDING,
+                    )
+                ):
+                    payment.state = OrderPayment.PAYMENT_STATE_PENDING
+                    payment.info_data = info
+                    payment.save(update_fields=["state", "info"])
+                elif payment.state not in (
                     OrderPayment.PAYMENT_STATE_CONFIRMED,
                     OrderPayment.PAYMENT_STATE_REFUNDED,
                 ):
-                    payment.info_data = data
-                    payment.save(update_fields=["info"])
-                    payment.confirm()
-            # Error || Fatal Error
-            elif data["Code"][:1] in ["2", "4"]:
+                    # confirm() persists info together with the state change
+                    payment.info_data = info
+                    payment.confirm(send_mail=send_mail)
+            elif result.action == ACTION_FAIL:
                 if payment.state not in (
                     OrderPayment.PAYMENT_STATE_CONFIRMED,
                     OrderPayment.PAYMENT_STATE_REFUNDED,
                 ):
-                    payment.fail(info=data)
-            # Continue / Transient || EMV 3DS Info
-            elif data["Code"][:1] in ["6", "7"]:
+                    payment.fail(info=info, send_mail=send_mail)
+            elif result.action == ACTION_PENDING:
                 if payment.state == OrderPayment.PAYMENT_STATE_CREATED:
                     payment.state = OrderPayment.PAYMENT_STATE_PENDING
-                    payment.info_data = data
+                    payment.info_data = info
                     payment.save(update_fields=["state", "info"])
-            else:
-                payment.fail(info=data)
 
         elif isinstance(payment_or_refund, OrderRefund) and payment_or_refund.state in (
             OrderRefund.REFUND_STATE_CREATED,
@@ -295,41 +457,31 @@ class ComputopMethod(BasePaymentProvider):
         ):
             refund = payment_or_refund
 
-            # OK
-            if data["Code"][:1] == "0":
-                refund.info_data = data
-                refund.save(update_fields=["info"])
+            if result.action == ACTION_CONFIRM:
+                # done() persists info together with the state change
+                refund.info_data = data.to_info()
                 refund.done()
-            # Error || Fatal Error
-            elif data["Code"][:1] in ["2", "4"]:
-                refund.state = OrderRefund.REFUND_STATE_FAILED
-                refund.execution_date = now()
-                refund.info_data = data
-                refund.save(update_fields=["state", "execution_date", "info"])
-            # Continue / Transient || EMV 3DS Info
-            elif data["Code"][:1] in ["6", "7"]:
+            elif result.action == ACTION_PENDING:
                 refund.state = OrderRefund.REFUND_STATE_TRANSIT
-                refund.info_data = data
+                refund.info_data = data.to_info()
                 refund.save(update_fields=["state", "info"])
             else:
                 refund.state = OrderRefund.REFUND_STATE_FAILED
                 refund.execution_date = now()
-                refund.info_data = data
+                refund.info_data = data.to_info()
                 refund.save(update_fields=["state", "execution_date", "info"])
         else:
             raise PaymentException(_("We had trouble processing your transaction."))
 
     def _encrypt(self, plaintext):
-        key = self.settings.get("blowfish_password").encode("UTF-8")
-        cipher = Blowfish.new(key, Blowfish.MODE_ECB)
+        cipher = _get_cipher(self.settings.get("blowfish_password"))
         bs = Blowfish.block_size
         padded_text = Padding.pad(plaintext.encode("UTF-8"), bs)
         encrypted_text = cipher.encrypt(padded_text)
         return b16encode(encrypted_text).decode(), len(plaintext)
 
     def _decrypt(self, ciphertext):
-        key = self.settings.get("blowfish_password").encode("UTF-8")
-        cipher = Blowfish.new(key, Blowfish.MODE_ECB)
+        cipher = _get_cipher(self.settings.get("blowfish_password"))
         bs = Blowfish.block_size
         ciphertext_bytes = b16decode(ciphertext)
         try:
@@ -364,18 +516,15 @@ class ComputopMethod(BasePaymentProvider):
             ]
         )
         plain = cat.encode("UTF-8")
-        secret = self.settings.get("hmac_password").encode("UTF-8")
-        h = HMAC.new(secret, digestmod=SHA256)
+        h = _get_hmac(self.settings.get("hmac_password")).copy()
         h.update(plain)
         return h.hexdigest().upper()
 
     def _amount_to_decimal(self, cents):
-        places = settings.CURRENCY_PLACES.get(self.event.currency, 2)
-        return round_decimal(float(cents) / (10**places), self.event.currency)
+        return from_minor_units(cents, self.event.currency)
 
     def _decimal_to_int(self, amount):
-        places = settings.CURRENCY_PLACES.get(self.event.currency, 2)
-        return int(amount * 10**places)
+        return to_minor_units(amount, self.event.currency)
 
     def _get_payment_data(self, payment: OrderPayment):
         ident = self.identifier.split("_")[0]
@@ -401,6 +550,7 @@ class ComputopMethod(BasePaymentProvider):
                 "payment_provider": ident,
             },
         )
+        amount = self._decimal_to_int(payment.amount)
         data = {
             "MerchantID": self.settings.get("merchant_id"),
             "TransID": trans_id,
@@ -410,7 +560,7 @@ class ComputopMethod(BasePaymentProvider):
                 payment.full_id,
             ),
             "RefNr": ref_nr,
-            "Amount": self._decimal_to_int(payment.amount),
+            "Amount": amount,
             "Currency": self.event.currency,
             "URLSuccess": return_url,
             "URLFailure": return_url,
@@ -418,33 +568,74 @@ class ComputopMethod(BasePaymentProvider):
             "URLBack": return_url,
             "MAC": self._calculate_hmac(
                 transaction_id=trans_id,
-                amount_or_status=str(self._decimal_to_int(payment.amount)),
+                amount_or_status=str(amount),
                 currency_or_code=self.event.currency,
             ),
             "Response": "encrypt",
         }
+        if self.capture_manual:
+            data["Capture"] = "MANUAL"
         return data
 
     def _get_refund_data(self, refund: OrderRefund):
+        return self._get_credit_data(
+            load_info(refund.payment)["PayID"], refund.full_id, refund.amount
+        )
+
+    def _get_credit_data(self, pay_id, trans_id, amount):
+        amount = self._decimal_to_int(amount)
+        data = {
+            "MerchantID": self.settings.get("merchant_id"),
+            "Amount": amount,
+            "Currency": self.event.currency,
+            "MAC": self._calculate_hmac(
+                payment_id=pay_id,
+                transaction_id=trans_id,
+                amount_or_status=str(amount),
+                currency_or_code=self.event.currency,
+            ),
+            "PayID": pay_id,
+            "TransID": trans_id,
+        }
+        return data
+
+    def _get_capture_data(self, payment: OrderPayment):
+        pay_id = load_info(payment)["PayID"]
+        amount = self._decimal_to_int(payment.amount)
         data = {
             "MerchantID": self.settings.get("merchant_id"),
-            "Amount": self._decimal_to_int(refund.amount),
+            "Amount": amount,
             "Currency": self.event.currency,
             "MAC": self._calculate_hmac(
-                payment_id=refund.payment.info_data["PayID"],
-                transaction_id=refund.full_id,
-                amount_or_status=str(self._decimal_to_int(refund.amount)),
+                payment_id=pay_id,
+                transaction_id=payment.full_id,
+                amount_or_status=str(amount),
                 currency_or_code=self.event.currency,
             ),
-            "PayID": refund.payment.info_data["PayID"],
-            "TransID": refund.full_id,
+            "PayID": pay_id,
+            "TransID": payment.full_id,
+            "RefNr": payment.full_id,
         }
         return data
 
 
+def get_capture_manual_field():
+    return (
+        "capture_manual",
+        forms.BooleanField(
+            label=_("Capture payments manually"),
+            help_text=_(
+                "Payments are only authorized during checkout and stay pending until they are captured in bulk "
+                "by your administrator, e.g. once the event has been confirmed."
+            ),
+            required=False,
+        ),
+    )
+
+
 class ComputopEDD(ComputopMethod):
-    apiurl = "https://www.computop-paygate.com/paysdd.aspx"
-    extra_form_fields = []
+    apipath = "paysdd.aspx"
+    extra_form_fields = [get_capture_manual_field()]
 
     def _get_payment_data(self, payment: OrderPayment):
         data = super()._get_payment_data(payment)
@@ -453,6 +644,14 @@ class ComputopEDD(ComputopMethod):
         data["DtOfSgntr"] = payment.created.strftime("%d.%m.%Y")
         return data
 
+    def _get_capture_data(self, payment: OrderPayment):
+        # With manual capture, the capture is what actually submits the debit
+        data = super()._get_capture_data(payment)
+        data["MandateID"] = payment.full_id
+        data["DtOfSgntr"] = payment.created.strftime("%d.%m.%Y")
+        data["MdtSeqType"] = "OOFF"
+        return data
+
     def get_refund_data(self, refund: OrderRefund):
         data = super()._get_refund_data(refund)
         data["RefNr"] = refund.full_id  # not for EVO
@@ -460,7 +659,7 @@ class ComputopEDD(ComputopMethod):
 
 
 class ComputopCC(ComputopMethod):
-    apiurl = "https://www.computop-paygate.com/payssl.aspx"
+    apipath = "payssl.aspx"
     extra_form_fields = [
         (
             "walletdetection",
@@ -478,6 +677,7 @@ class ComputopCC(ComputopMethod):
                 required=False,
             )
         ),
+        get_capture_manual_field(),
     ]
 
     def _get_payment_data(self, payment: OrderPayment):
@@ -501,10 +701,10 @@ class ComputopCC(ComputopMethod):
 
 
 class ComputopGiropay(ComputopMethod):
-    apiurl = "https://www.computop-paygate.com/giropay.aspx"
+    apipath = "giropay.aspx"
     extra_form_fields = []
 
 
 class ComputopWero(ComputopMethod):
-    apiurl = "https://www.computop-paygate.com/wero.aspx"
+    apipath = "wero.aspx"
     extra_form_fields = []
@@ -1,5 +1,7 @@
+import importlib
 from django import forms
 from django.utils.translation import gettext_lazy as _
+from functools import lru_cache
 
 from .payment import (ComputopCC, ComputopEDD, ComputopGiropay, ComputopMethod,
                       ComputopSettingsHolder, ComputopWero)
@@ -283,3 +285,18 @@ def get_payment_method_classes(brand, payment_methods, baseclass, settingsholder
 payment_method_classes = get_payment_method_classes(
     "Computop", payment_methods, ComputopMethod, ComputopSettingsHolder
 )
+
+
+@lru_cache(maxsize=None)
+def get_provider_identifiers(brand, methods=None):
+    """
+    Returns the identifiers of all payment providers of a brand, optionally limited to
+    the given payment methods.
+    """
+    module = importlib.import_module("pretix_{}.paymentmethods".format(brand.lower()))
+    return tuple(
+        c.identifier
+        for c in module.payment_method_classes
+        # is_meta is a property on the method classes, only the settings holder sets it
+        if c.is_meta is not True and (methods is None or c.method in methods)
+    )
@@ -0,0 +1,192 @@
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from django.conf import settings
+from django.db import connection
+from functools import lru_cache
+
+logger = logging.getLogger("pretix_computop")
+
+_local = threading.local()
+
+
+@lru_cache(maxsize=None)
+def get_config():
+    """
+    Reads the profiler configuration from the ``[computop]`` section of the pretix
+    config file. Profiling is disabled unless ``profile_threshold_ms`` is set.
+    """
+    config = settings.CONFIG_FILE
+    return {
+        "threshold": config.getint("computop", "profile_threshold_ms", fallback=0)
+        / 1000,
+        "interval": config.getint("computop", "profile_interval_ms", fallback=5)
+        / 1000,
+        "keep": config.getint("computop", "profile_keep", fallback=100),
+        "directory": config.get(
+            "computop",
+            "profile_dir",
+            fallback=os.path.join(settings.DATA_DIR, "computop_profiles"),
+        ),
+    }
+
+
+def _fold(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(
+            "{}:{}".format(os.path.basename(code.co_filename), code.co_name)
+        )
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class Sampler:
+    """
+    Samples the stacks of all threads currently inside a profiled call. The sampling
+    thread only runs while at least one such call is active.
+    """
+
+    def __init__(self):
+        self.active = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self, thread_id, interval):
+        samples = Counter()
+        with self.lock:
+            self.active[thread_id] = samples
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run,
+                    args=(interval,),
+                    daemon=True,
+                    name="computop-profiler",
+                )
+                self.thread.start()
+        return samples
+
+    def stop(self, thread_id):
+        """
+        Stops sampling the thread. A sampling round that is running at that time
+        is waited for, so the returned samples don't change anymore.
+        """
+        with self.lock:
+            return self.active.pop(thread_id, None)
+
+    def _run(self, interval):
+        while True:
+            # Samples are only taken while holding the lock, which keeps them
+            # consistent with start() and stop().
+            with self.lock:
+                if not self.active:
+                    self.thread = None
+                    return
+                frames = sys._current_frames()
+                for thread_id, samples in self.active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[_fold(frame)] += 1
+            # Frames keep their locals alive, don't hold on to them while sleeping
+            del frames
+            time.sleep(interval)
+
+
+sampler = Sampler()
+
+
+class QueryStats:
+    """
+    Counts the queries of a profiled call. Time spent in locking queries is
+    reported as lock wait.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0
+        self.lock_wait = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.monotonic() - started
+            self.count += 1
+            self.time += elapsed
+            if "FOR UPDATE" in sql:
+                self.lock_wait += elapsed
+
+
+def _write_profile(config, name, duration, samples, queries):
+    directory = config["directory"]
+    os.makedirs(directory, exist_ok=True)
+    basename = "{:.6f}-{}-{}ms".format(time.time(), name, int(duration * 1000))
+    # Collapsed stacks, as read by flamegraph.pl, speedscope and others
+    with open(os.path.join(directory, basename + ".folded"), "w") as f:
+        for stack, count in samples.most_common():
+            f.write("{} {}\n".format(stack, count))
+    with open(os.path.join(directory, basename + ".json"), "w") as f:
+        json.dump(
+            {
+                "name": name,
+                "duration": duration,
+                "samples": sum(samples.values()),
+                "queries": queries.count,
+                "query_time": queries.time,
+                "lock_wait": queries.lock_wait,
+            },
+            f,
+        )
+
+    profiles = sorted(p for p in os.listdir(directory) if p.endswith(".folded"))
+    for p in profiles[: max(len(profiles) - config["keep"], 0)]:
+        for suffix in (".folded", ".json"):
+            try:
+                os.remove(os.path.join(directory, p[: -len(".folded")] + suffix))
+            except FileNotFoundError:
+                pass
+
+
+def profiled(name):
+    """
+    Samples the stack of the decorated call and keeps the samples on disk if the
+    call took longer than the configured threshold. Nested profiled calls are
+    accounted to the outermost one.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            config = get_config()
+            if not config["threshold"] or getattr(_local, "active", False):
+                return func(*args, **kwargs)
+
+            _local.active = True
+            thread_id = threading.get_ident()
+            queries = QueryStats()
+            samples = sampler.start(thread_id, config["interval"])
+            started = time.monotonic()
+            try:
+                with connection.execute_wrapper(queries):
+                    return func(*args, **kwargs)
+            finally:
+                duration = time.monotonic() - started
+                sampler.stop(thread_id)
+                _local.active = False
+                if duration >= config["threshold"]:
+                    # Never let the profiler break the profiled call
+                    try:
+                        _write_profile(config, name, duration, samples, queries)
+                    except Exception:
+                        logger.exception("Could not write profile")
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,86 @@
+import logging
+import time
+from django.conf import settings
+from django.core.cache import cache
+
+from .response import compact_info
+
+INDEX_KEY = "pretix_computop_callback_recording_index"
+SLOT_KEY = "pretix_computop_callback_recording_{}"
+CACHE_TIMEOUT = 7 * 24 * 3600
+
+logger = logging.getLogger("pretix_computop")
+
+
+def is_enabled():
+    return settings.CONFIG_FILE.getboolean(
+        "computop", "record_callbacks", fallback=False
+    )
+
+
+def get_size():
+    return settings.CONFIG_FILE.getint(
+        "computop", "record_callbacks_size", fallback=1000
+    )
+
+
+def _next_index():
+    try:
+        return cache.incr(INDEX_KEY)
+    except ValueError:
+        # Either the first callback or another process just created the counter
+        if cache.add(INDEX_KEY, 1, None):
+            return 1
+        return cache.incr(INDEX_KEY)
+
+
+def record_callback(
+    request, order, payment_id, viewsource, response, valid, size, duration
+):
+    """
+    Stores an inbound callback in a bounded ring buffer in the cache.
+
+    Every callback goes into its own slot, picked by an atomic counter, so recording
+    costs one increment and one write regardless of the buffer size. Instead of the
+    encrypted blob, only the fields we persist on the payment anyway are recorded,
+    without the MAC and merchant ID. Recordings of live orders therefore contain
+    nothing that isn't already visible in the backend, and the replay command
+    encrypts and signs them again with the local credentials.
+
+    Recording is best effort: the callback has already been processed, so errors of
+    the cache are logged and never reach the paygate.
+    """
+    if not is_enabled() or response is None:
+        return
+
+    fields = compact_info(response)
+    del fields["_v"]
+    try:
+        cache.set(
+            SLOT_KEY.format(_next_index() % get_size()),
+            {
+                "t": time.time(),
+                "source": viewsource,
+                "organizer": request.organizer.slug,
+                "event": request.event.slug,
+                "order": order.code,
+                "testmode": order.testmode,
+                "payment": payment_id,
+                "fields": fields,
+                "valid": valid,
+                "size": size,
+                "duration": duration,
+            },
+            CACHE_TIMEOUT,
+        )
+    except Exception:
+        logger.warning("Could not record callback", exc_info=True)
+
+
+def get_recording():
+    records = cache.get_many([SLOT_KEY.format(i) for i in range(get_size())])
+    return sorted(records.values(), key=lambda r: r["t"])
+
+
+def clear_recording():
+    cache.delete_many([SLOT_KEY.format(i) for i in range(get_size())] + [INDEX_KEY])
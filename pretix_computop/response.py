@@ -0,0 +1,124 @@
+from urllib.parse import unquote_plus
+
+# Version of the layout we store in OrderPayment.info and OrderRefund.info. Rows
+# without a version still contain the full paygate response or outgoing request.
+# They are compacted in memory when they are read and can be rewritten in place
+# with the computop_compact_info management command.
+INFO_VERSION = 2
+
+# Only these fields of a paygate response are persisted. Everything else
+# (including the MAC) is only kept in the order's log.
+PERSISTED_FIELDS = (
+    "PayID",
+    "XID",
+    "TransID",
+    "Status",
+    "Code",
+    "Description",
+    "pt",
+    "CCBrand",
+    # Not sent by the paygate, but part of our payment request when the payment is
+    # only authorized and captured later. Kept on the payment across responses.
+    "Capture",
+)
+
+
+class ComputopResponse:
+    """
+    A decrypted paygate response.
+
+    Behaves like a read-only mapping for the keys sent by the paygate, so callers can
+    keep using ``response["Code"]`` or ``response.get("PayID")``.
+    """
+
+    __slots__ = (
+        "mid",
+        "PayID",
+        "XID",
+        "TransID",
+        "Status",
+        "Code",
+        "Description",
+        "MAC",
+        "pt",
+        "CCBrand",
+        "extra",
+    )
+
+    def __init__(self, **fields):
+        for name in self.__slots__[:-1]:
+            setattr(self, name, fields.pop(name, None))
+        self.extra = fields
+
+    @classmethod
+    def parse(cls, payload: str):
+        """
+        Parses the paygate's ``key=value&key=value`` format in a single pass.
+
+        Like ``parse_qsl``, pairs with an empty value are dropped.
+        """
+        fields = {}
+        for pair in payload.split("&"):
+            key, sep, value = pair.partition("=")
+            if not sep or not value:
+                continue
+            if "%" in key or "+" in key:
+                key = unquote_plus(key)
+            if "%" in value or "+" in value:
+                value = unquote_plus(value)
+            fields[key] = value
+        return cls(**fields)
+
+    def get(self, key, default=None):
+        if key in self.__slots__ and key != "extra":
+            value = getattr(self, key)
+            return default if value is None else value
+        return self.extra.get(key, default)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def to_dict(self):
+        d = {
+            name: getattr(self, name)
+            for name in self.__slots__[:-1]
+            if getattr(self, name) is not None
+        }
+        d.update(self.extra)
+        return d
+
+    def to_info(self):
+        return compact_info(self)
+
+
+def compact_info(data):
+    info = {"_v": INFO_VERSION}
+    for key in PERSISTED_FIELDS:
+        value = data.get(key)
+        if value is not None:
+            info[key] = value
+    return info
+
+
+def load_info(payment_or_refund):
+    """
+    Returns the compact info of a payment or refund.
+
+    The result is cached on the instance for as long as its ``info`` is unchanged, so
+    rendering and API serialization only parse the JSON once.
+    """
+    cached = getattr(payment_or_refund, "_computop_info", None)
+    if cached is not None and cached[0] is payment_or_refund.info:
+        return cached[1]
+
+    info = payment_or_refund.info_data
+    if info.get("_v") != INFO_VERSION:
+        info = compact_info(info)
+    payment_or_refund._computop_info = (payment_or_refund.info, info)
+    return info
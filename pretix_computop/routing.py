@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+# Orders that have been written by this plugin within this many seconds are always
+# read from the primary database, as the replica may not have caught up yet.
+REPLICA_MAX_LAG = 30
+
+# Cache backends that don't share the recent write markers between the processes of
+# a deployment. With these, the markers can't be trusted.
+LOCAL_CACHE_BACKENDS = (DummyCache, LocMemCache)
+
+
+def _recent_write_key(event_id, order_code):
+    return "pretix_computop_recent_write_{}_{}".format(event_id, order_code)
+
+
+def get_replica():
+    return getattr(settings, "DATABASE_REPLICA", "default")
+
+
+def _can_track_writes():
+    return not isinstance(caches["default"], LOCAL_CACHE_BACKENDS)
+
+
+def mark_written(order):
+    if get_replica() != "default":
+        cache.set(_recent_write_key(order.event_id, order.code), True, REPLICA_MAX_LAG)
+
+
+def get_read_db(event_id=None, order_code=None):
+    """
+    Returns the database alias to use for a read that does not need a lock.
+
+    Reads go to the replica configured in pretix, unless the order they concern has
+    recently been written. If the cache can't tell which orders have been written,
+    reads of a specific order always use the primary. Locking reads and writes must
+    always use the primary.
+    """
+    replica = get_replica()
+    if replica == "default":
+        return replica
+    if order_code and (
+        not _can_track_writes() or cache.get(_recent_write_key(event_id, order_code))
+    ):
+        return "default"
+    return replica
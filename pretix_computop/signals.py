@@ -1,6 +1,13 @@
 from django.dispatch import receiver
+from django.urls import resolve, reverse
 from django.utils.translation import gettext_lazy as _  # NoQA
-from pretix.base.signals import logentry_display, register_payment_providers
+from pretix.base.signals import (
+    logentry_display,
+    periodic_task,
+    register_payment_providers,
+)
+from pretix.control.signals import nav_organizer
+from pretix.helpers.periodic import minimum_interval
 
 
 @receiver(register_payment_providers, dispatch_uid="payment_computop")
@@ -12,7 +19,47 @@ def register_payment_provider(sender, **kwargs):
 
 @receiver(signal=logentry_display, dispatch_uid="payment_computop_logentry_display")
 def logentry_display(sender, logentry, **kwargs):
-    if logentry.action_type != "pretix_computop.event":
-        return
+    if logentry.action_type == "pretix_computop.event":
+        return _("Computop reported an event")
+    if logentry.action_type == "pretix_computop.organizer.settings":
+        return _("The payment provider credentials have been changed.")
 
-    return _("Computop reported an event")
+
+@receiver(periodic_task, dispatch_uid="payment_computop_periodic_refunds")
+def send_queued_refunds(sender, **kwargs):
+    from .coalesce import flush_queued_refunds
+
+    flush_queued_refunds()
+
+
+@receiver(periodic_task, dispatch_uid="payment_computop_periodic_sweep")
+@minimum_interval(minutes_after_success=60)
+def cancel_stale_payments(sender, **kwargs):
+    from .sweeper import sweep_stale_payments
+
+    sweep_stale_payments()
+
+
+def get_organizer_nav(brand, brand_name, request, organizer):
+    if not request.user.has_organizer_permission(
+        organizer, "can_change_organizer_settings", request
+    ):
+        return []
+    url = resolve(request.path_info)
+    return [
+        {
+            "label": brand_name,
+            "url": reverse(
+                "plugins:pretix_{}:settings".format(brand),
+                kwargs={"organizer": organizer.slug},
+            ),
+            "active": url.namespace == "plugins:pretix_{}".format(brand)
+            and url.url_name == "settings",
+            "icon": "credit-card",
+        }
+    ]
+
+
+@receiver(nav_organizer, dispatch_uid="payment_computop_nav_organizer")
+def nav_organizer_computop(sender, request, organizer, **kwargs):
+    return get_organizer_nav("computop", "Computop", request, organizer)
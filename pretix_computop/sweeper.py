@@ -0,0 +1,107 @@
+import json
+import logging
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import LogEntry, OrderPayment
+from pretix.helpers import OF_SELF
+
+from .capture import BRANDS
+from .paymentmethods import get_provider_identifiers
+from .response import INFO_VERSION
+from .routing import get_read_db
+
+logger = logging.getLogger("pretix_computop")
+
+
+def get_stale_payments(cutoff):
+    """
+    Payments that have been created before ``cutoff`` and never received a callback.
+
+    Every callback moves the payment out of the created state, so the state alone
+    tells them apart and the info column is never searched.
+    """
+    identifiers = [i for brand in BRANDS for i in get_provider_identifiers(brand)]
+    return OrderPayment.objects.filter(
+        provider__in=identifiers,
+        state=OrderPayment.PAYMENT_STATE_CREATED,
+        created__lt=cutoff,
+    )
+
+
+def sweep_stale_payments(max_age=None, batch_size=1000):
+    """
+    Cancels stale payments in batches of ``batch_size``, each in its own short
+    transaction together with the log entries pretix writes for a canceled payment.
+    Returns the number of canceled payments and the elapsed time.
+    """
+    if max_age is None:
+        max_age = timedelta(
+            hours=settings.CONFIG_FILE.getint(
+                "computop", "stale_payment_hours", fallback=24
+            )
+        )
+    cutoff = now() - max_age
+    info = json.dumps(
+        {
+            "_v": INFO_VERSION,
+            "Description": "Canceled because the payment process was not completed",
+        },
+        sort_keys=True,
+    )
+    swept = 0
+    last_pk = 0
+    started = time.monotonic()
+
+    with scopes_disabled():
+        while True:
+            # Walk the primary key instead of using OFFSET, so every batch is a
+            # cheap index range scan.
+            ids = list(
+                get_stale_payments(cutoff)
+                .using(get_read_db())
+                .filter(pk__gt=last_pk)
+                .order_by("pk")
+                .values_list("pk", flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            last_pk = ids[-1]
+            with transaction.atomic():
+                # Re-check the conditions, a callback may have arrived meanwhile
+                payments = list(
+                    get_stale_payments(cutoff)
+                    .select_for_update(of=OF_SELF)
+                    .select_related("order__event")
+                    .filter(pk__in=ids)
+                )
+                if not payments:
+                    continue
+                OrderPayment.objects.filter(pk__in=[p.pk for p in payments]).update(
+                    state=OrderPayment.PAYMENT_STATE_CANCELED, info=info
+                )
+                # Also sends the notifications and webhooks of the log entries,
+                # like log_action() does for a single payment.
+                LogEntry.bulk_create_and_postprocess(
+                    [
+                        p.order.log_action(
+                            "pretix.event.order.payment.canceled",
+                            {"local_id": p.local_id, "provider": p.provider},
+                            save=False,
+                        )
+                        for p in payments
+                    ]
+                )
+                swept += len(payments)
+
+    elapsed = time.monotonic() - started
+    logger.info(
+        "Canceled %d stale payments in %.2fs (%.1f/s)",
+        swept,
+        elapsed,
+        swept / elapsed if elapsed else 0,
+    )
+    return swept, elapsed
@@ -1,28 +1,62 @@
+from django.conf import settings
 from django.urls import include, path, re_path
 
-from .views import NotifyView, ReturnView
+from .paymentmethods import get_provider_identifiers
+from .views import (
+    AsyncNotifyView,
+    NotifyView,
+    OrganizerSettingsView,
+    ReturnView,
+    StatusView,
+)
+
+
+def get_notify_view():
+    if settings.CONFIG_FILE.getboolean("computop", "async_callbacks", fallback=False):
+        return AsyncNotifyView
+    return NotifyView
 
 
 def get_event_patterns(brand):
+    provider_identifiers = get_provider_identifiers(brand)
     return [
-        re_path(
-            r"^(?P<payment_provider>{})/".format(brand),
+        path(
+            "{}/".format(brand),
             include(
                 [
                     path(
                         "return/<str:order>/<str:hash>/<str:payment>/",
-                        ReturnView.as_view(),
+                        ReturnView.as_view(provider_identifiers=provider_identifiers),
                         name="return",
                     ),
                     path(
                         "notify/<str:order>/<str:hash>/<str:payment>/",
-                        NotifyView.as_view(),
+                        get_notify_view().as_view(
+                            provider_identifiers=provider_identifiers
+                        ),
                         name="notify",
                     ),
+                    path(
+                        "status/<str:order>/<str:hash>/<str:payment>/",
+                        StatusView.as_view(provider_identifiers=provider_identifiers),
+                        name="status",
+                    ),
                 ]
             ),
+            {"payment_provider": brand},
+        ),
+    ]
+
+
+def get_urlpatterns(brand, brand_name):
+    return [
+        re_path(
+            r"^control/organizer/(?P<organizer>[^/]+)/{}/$".format(brand),
+            OrganizerSettingsView.as_view(brand=brand, brand_name=brand_name),
+            name="settings",
         ),
     ]
 
 
 event_patterns = get_event_patterns("computop")
+urlpatterns = get_urlpatterns("computop", "Computop")
@@ -1,28 +1,75 @@
+import asyncio
 import hashlib
+import time
+from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
 from django.contrib import messages
-from django.db import transaction
+from django.db import OperationalError, transaction
 from django.http import Http404, HttpResponse, HttpResponseServerError
-from django.shortcuts import get_object_or_404, redirect
+from django.shortcuts import get_object_or_404, redirect, render
+from django.urls import reverse
 from django.utils.decorators import method_decorator
 from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
+from django.views.generic import FormView
+from functools import lru_cache
 from pretix.base.models import Order, OrderPayment
 from pretix.base.payment import PaymentException
+from pretix.control.permissions import OrganizerPermissionRequiredMixin
+from pretix.control.views.organizer import OrganizerDetailViewMixin
 from pretix.helpers import OF_SELF
 from pretix.multidomain.urlreverse import eventreverse
 
+from .forms import OrganizerSettingsForm
+from .profiling import profiled
+from .recorder import record_callback
+from .routing import get_read_db
+
+# SQLSTATE of PostgreSQL's lock_not_available and MySQL's ER_LOCK_NOWAIT, raised by
+# SELECT ... FOR UPDATE NOWAIT when another transaction holds the row.
+LOCK_NOT_AVAILABLE_SQLSTATE = "55P03"
+LOCK_NOT_AVAILABLE_MYSQL = 3572
+
+
+def is_lock_not_available(exc):
+    cause = exc.__cause__
+    sqlstate = getattr(cause, "pgcode", None) or getattr(cause, "sqlstate", None)
+    if sqlstate == LOCK_NOT_AVAILABLE_SQLSTATE:
+        return True
+    args = getattr(cause, "args", ())
+    return bool(args) and args[0] == LOCK_NOT_AVAILABLE_MYSQL
+
 
 class ComputopOrderView:
-    def dispatch(self, request, *args, **kwargs):
+    lock_nowait = False
+    viewsource = None
+    # The parsed callback and the result of its hash check, set by the views for
+    # the callback recorder.
+    recorded = None
+    # Identifiers of the brand's payment providers, resolved once when the URLs
+    # are loaded. Matching them exactly lets the database use the provider index.
+    provider_identifiers = ()
+
+    def get_order(self, request, kwargs):
         try:
-            self.order = request.event.orders.get(code=kwargs["order"])
+            # Only the columns needed for the hash check and the redirect, the full
+            # order is loaded together with the locked payment when it is needed.
+            # Nothing is locked here, so the lookup can run on the replica.
+            db = get_read_db(request.event.pk, kwargs["order"])
+            order = (
+                request.event.orders.using(db)
+                .only("pk", "code", "secret", "status", "testmode")
+                .get(code=kwargs["order"])
+            )
             if (
-                hashlib.sha1(self.order.secret.lower().encode()).hexdigest()
+                hashlib.sha1(order.secret.lower().encode()).hexdigest()
                 != kwargs["hash"].lower()
             ):
                 raise Http404("Unknown order")
+            return order
         except Order.DoesNotExist:
             # Do a hash comparison as well to harden timing attacks
             if (
@@ -32,16 +79,43 @@ class ComputopOrderView:
                 raise Http404("Unknown order")
             else:
                 raise Http404("Unknown order")
-        return super().dispatch(request, *args, **kwargs)
+
+    def dispatch(self, request, *args, **kwargs):
+        self.order = self.get_order(request, kwargs)
+        started = time.monotonic()
+        response = super().dispatch(request, *args, **kwargs)
+        if self.viewsource and self.recorded:
+            data = request.POST.get("Data") or request.GET.get("Data")
+            record_callback(
+                request,
+                self.order,
+                kwargs["payment"],
+                self.viewsource,
+                *self.recorded,
+                len(data),
+                time.monotonic() - started,
+            )
+        return response
 
     def get_payment_for_update(self) -> OrderPayment:
         try:
-            return self.order.payments.select_for_update(of=OF_SELF).get(
-                pk=self.kwargs["payment"],
-                provider__istartswith=self.kwargs["payment_provider"],
+            payment = (
+                OrderPayment.objects.select_for_update(
+                    of=OF_SELF, nowait=self.lock_nowait
+                )
+                .select_related("order")
+                .get(
+                    pk=self.kwargs["payment"],
+                    order_id=self.order.pk,
+                    provider__in=self.provider_identifiers,
+                )
             )
         except OrderPayment.DoesNotExist:
             raise Http404("Unknown payment")
+        # Share the event (and its cached settings and providers) with the request
+        payment.order.event = self.request.event
+        self.order = payment.order
+        return payment
 
     def _redirect_to_order(self):
         return redirect(
@@ -53,20 +127,44 @@ class ComputopOrderView:
             + ("?paid=yes" if self.order.status == Order.STATUS_PAID else "")
         )
 
+    def _redirect_to_status(self):
+        return redirect(
+            eventreverse(
+                self.request.event,
+                "plugins:pretix_{}:status".format(self.kwargs["payment_provider"]),
+                kwargs={
+                    "order": self.kwargs["order"],
+                    "hash": self.kwargs["hash"],
+                    "payment": self.kwargs["payment"],
+                },
+            )
+        )
+
 
 @method_decorator(csrf_exempt, name="dispatch")
 class ReturnView(ComputopOrderView, View):
     template_name = "pretix_computop/return.html"
     viewsource = "return_view"
+    # The notify call usually arrives at the same time, the customer should not
+    # have to wait for it to release the payment.
+    lock_nowait = True
 
     def read_and_process(self, request_body):
         if request_body.get("Data"):
-            payment = self.get_payment_for_update()
+            try:
+                with transaction.atomic():
+                    payment = self.get_payment_for_update()
+            except OperationalError as e:
+                if not is_lock_not_available(e):
+                    raise
+                return self._redirect_to_status()
             pprov = payment.payment_provider
 
             try:
                 response = pprov.parse_data(request_body.get("Data"))
-                if pprov.check_hash(response):
+                valid = pprov.check_hash(response)
+                self.recorded = (response, valid)
+                if valid:
                     pprov.process_result(payment, response, self.viewsource)
                 else:
                     messages.error(
@@ -80,15 +178,157 @@ class ReturnView(ComputopOrderView, View):
                 messages.error(self.request, str(e))
                 return self._redirect_to_order()
 
+    @profiled("return_view")
     @transaction.atomic
     def post(self, request, *args, **kwargs):
-        self.read_and_process(request.POST)
-        return self._redirect_to_order()
+        return self.read_and_process(request.POST) or self._redirect_to_order()
 
+    @profiled("return_view")
     @transaction.atomic
     def get(self, request, *args, **kwargs):
-        self.read_and_process(request.GET)
-        return self._redirect_to_order()
+        return self.read_and_process(request.GET) or self._redirect_to_order()
+
+
+class StatusView(ComputopOrderView, View):
+    template_name = "pretix_computop/pending.html"
+    refresh_interval = 2
+    max_attempts = 15
+
+    def get(self, request, *args, **kwargs):
+        state = (
+            OrderPayment.objects.using(get_read_db(request.event.pk, self.order.code))
+            .filter(
+                pk=self.kwargs["payment"],
+                order_id=self.order.pk,
+                provider__in=self.provider_identifiers,
+            )
+            .values_list("state", flat=True)
+            .first()
+        )
+        if state is None:
+            raise Http404("Unknown payment")
+
+        try:
+            attempt = int(request.GET.get("attempt", "0"))
+        except ValueError:
+            attempt = 0
+
+        if (
+            state
+            not in (
+                OrderPayment.PAYMENT_STATE_CREATED,
+                OrderPayment.PAYMENT_STATE_PENDING,
+            )
+            or attempt >= self.max_attempts
+        ):
+            return self._redirect_to_order()
+
+        return render(
+            request,
+            self.template_name,
+            {
+                "refresh_interval": self.refresh_interval,
+                "refresh_url": "{}?attempt={}".format(request.path, attempt + 1),
+                "order_url": eventreverse(
+                    request.event,
+                    "presale:event.order",
+                    kwargs={"order": self.order.code, "secret": self.order.secret},
+                ),
+            },
+        )
+
+
+@lru_cache(maxsize=None)
+def get_callback_semaphore():
+    return asyncio.Semaphore(
+        settings.CONFIG_FILE.getint("computop", "async_concurrency", fallback=100)
+    )
+
+
+@lru_cache(maxsize=None)
+def get_crypto_executor():
+    return ThreadPoolExecutor(
+        max_workers=settings.CONFIG_FILE.getint(
+            "computop", "async_crypto_workers", fallback=4
+        ),
+        thread_name_prefix="computop-crypto",
+    )
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class AsyncNotifyView(ComputopOrderView, View):
+    """
+    Variant of ``NotifyView`` for ASGI deployments.
+
+    Decryption and the hash check run in a small thread pool without holding a
+    database connection, only the locked transaction is handed to a sync thread.
+    """
+
+    viewsource = "notify_view"
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.order = await sync_to_async(self.get_order)(request, kwargs)
+        return await View.dispatch(self, request, *args, **kwargs)
+
+    def get_payment_provider(self):
+        provider = (
+            OrderPayment.objects.filter(
+                pk=self.kwargs["payment"],
+                order_id=self.order.pk,
+                provider__in=self.provider_identifiers,
+            )
+            .values_list("provider", flat=True)
+            .first()
+        )
+        pprov = self.request.event.get_payment_providers(cached=True).get(provider)
+        if not pprov:
+            raise Http404("Unknown payment")
+        # Load the credentials now, so the crypto threads never touch the database
+        for key in ("merchant_id", "blowfish_password", "hmac_password"):
+            pprov.settings.get(key)
+        return pprov
+
+    @transaction.atomic
+    def process(self, response):
+        payment = self.get_payment_for_update()
+        try:
+            payment.payment_provider.process_result(payment, response, self.viewsource)
+        except PaymentException:
+            return False
+        return True
+
+    async def post(self, request, *args, **kwargs):
+        data = request.POST.get("Data")
+        if not data:
+            return HttpResponse("[accepted]", status=200)
+
+        started = time.monotonic()
+        async with get_callback_semaphore():
+            pprov = await sync_to_async(self.get_payment_provider)()
+            loop = asyncio.get_running_loop()
+            try:
+                response = await loop.run_in_executor(
+                    get_crypto_executor(), pprov.parse_data, data
+                )
+            except PaymentException:
+                return HttpResponseServerError()
+            valid = await loop.run_in_executor(
+                get_crypto_executor(), pprov.check_hash, response
+            )
+            if valid and not await sync_to_async(self.process)(response):
+                return HttpResponseServerError()
+
+        await sync_to_async(record_callback)(
+            request,
+            self.order,
+            kwargs["payment"],
+            self.viewsource,
+            response,
+            valid,
+            len(data),
+            time.monotonic() - started,
+        )
+        return HttpResponse("[accepted]", status=200)
 
 
 @method_decorator(csrf_exempt, name="dispatch")
@@ -96,6 +336,7 @@ class NotifyView(ComputopOrderView, View):
     template_name = "pretix_computop/return.html"
     viewsource = "notify_view"
 
+    @profiled("notify_view")
     @transaction.atomic
     def post(self, request, *args, **kwargs):
         if request.POST.get("Data"):
@@ -106,10 +347,55 @@ class NotifyView(ComputopOrderView, View):
                 response = pprov.parse_data(request.POST.get("Data"))
             except PaymentException:
                 return HttpResponseServerError()
-            if pprov.check_hash(response):
+            valid = pprov.check_hash(response)
+            self.recorded = (response, valid)
+            if valid:
                 try:
-                    payment = self.get_payment_for_update()
                     pprov.process_result(payment, response, self.viewsource)
                 except PaymentException:
                     return HttpResponseServerError()
         return HttpResponse("[accepted]", status=200)
+
+
+class OrganizerSettingsView(
+    OrganizerDetailViewMixin, OrganizerPermissionRequiredMixin, FormView
+):
+    form_class = OrganizerSettingsForm
+    template_name = "pretix_computop/organizer_settings.html"
+    permission = "can_change_organizer_settings"
+    brand = "computop"
+    brand_name = "Computop"
+
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs["obj"] = self.request.organizer
+        kwargs["brand"] = self.brand
+        return kwargs
+
+    def get_context_data(self, **kwargs):
+        ctx = super().get_context_data(**kwargs)
+        ctx["brand_name"] = self.brand_name
+        return ctx
+
+    def get_success_url(self):
+        return reverse(
+            "plugins:pretix_{}:settings".format(self.brand),
+            kwargs={"organizer": self.request.organizer.slug},
+        )
+
+    def form_valid(self, form):
+        form.save()
+        if form.has_changed():
+            self.request.organizer.log_action(
+                "pretix_computop.organizer.settings",
+                user=self.request.user,
+                data={"changed": form.changed_data},
+            )
+        messages.success(self.request, _("Your changes have been saved."))
+        return super().form_valid(form)
+
+    def form_invalid(self, form):
+        messages.error(
+            self.request, _("We could not save your changes. See below for details.")
+        )
+        return super().form_invalid(form)
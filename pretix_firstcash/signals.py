@@ -1,6 +1,9 @@
 from django.dispatch import receiver
 from django.utils.translation import gettext_lazy as _  # NoQA
 from pretix.base.signals import register_payment_providers
+from pretix.control.signals import nav_organizer
+
+from pretix_computop.signals import get_organizer_nav
 
 
 @receiver(register_payment_providers, dispatch_uid="payment_firstcash")
@@ -8,3 +11,8 @@ def register_payment_provider(sender, **kwargs):
     from .paymentmethods import payment_method_classes
 
     return payment_method_classes
+
+
+@receiver(nav_organizer, dispatch_uid="payment_firstcash_nav_organizer")
+def nav_organizer_firstcash(sender, request, organizer, **kwargs):
+    return get_organizer_nav("firstcash", "First Cash Solution", request, organizer)
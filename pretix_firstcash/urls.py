@@ -1,3 +1,4 @@
-from pretix_computop.urls import get_event_patterns
+from pretix_computop.urls import get_event_patterns, get_urlpatterns
 
 event_patterns = get_event_patterns("firstcash")
+urlpatterns = get_urlpatterns("firstcash", "First Cash Solution")
@@ -0,0 +1,169 @@
+import hashlib
+import pytest
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pretix.base.models import Event, Order, OrderPayment, Organizer
+from urllib.parse import parse_qsl, urlencode
+
+MERCHANT_ID = "TESTMID"
+PAY_ID = "0123456789abcdef0123456789abcdef"
+
+
+@pytest.fixture
+def env():
+    with scopes_disabled():
+        organizer = Organizer.objects.create(name="Dummy", slug="dummy")
+        event = Event.objects.create(
+            organizer=organizer,
+            name="Dummy",
+            slug="dummy",
+            date_from=now(),
+            live=True,
+            plugins="pretix_computop",
+        )
+        event.settings.set("payment_computop__enabled", True)
+        event.settings.set("payment_computop_method_CC", True)
+        event.settings.set("payment_computop_merchant_id", MERCHANT_ID)
+        event.settings.set("payment_computop_blowfish_password", "blowfishsecret")
+        event.settings.set("payment_computop_hmac_password", "hmacsecret")
+        order = Order.objects.create(
+            code="FOOBAR",
+            event=event,
+            email="dummy@dummy.test",
+            status=Order.STATUS_PENDING,
+            datetime=now(),
+            expires=now() + timedelta(days=10),
+            total=Decimal("13.37"),
+            locale="en",
+            sales_channel=organizer.sales_channels.get(identifier="web"),
+        )
+        payment = order.payments.create(
+            provider="computop_CC",
+            amount=order.total,
+            state=OrderPayment.PAYMENT_STATE_CREATED,
+        )
+        yield event, order, payment
+
+
+def get_provider(payment):
+    with scopes_disabled():
+        return payment.order.event.get_payment_providers()[payment.provider]
+
+
+def callback_url(view, payment):
+    return "/{}/{}/computop/{}/{}/{}/{}/".format(
+        payment.order.event.organizer.slug,
+        payment.order.event.slug,
+        view,
+        payment.order.code,
+        hashlib.sha1(payment.order.secret.lower().encode()).hexdigest(),
+        payment.pk,
+    )
+
+
+def paygate_data(
+    pprov, trans_id, code="00000000", status="OK", pay_id=PAY_ID, **fields
+):
+    """
+    Builds an encrypted ``Data`` blob as the paygate would send it.
+    """
+    fields.update(
+        {
+            "mid": MERCHANT_ID,
+            "PayID": pay_id,
+            "TransID": trans_id,
+            "Status": status,
+            "Code": code,
+            "MAC": pprov._calculate_hmac(pay_id, trans_id, status, code),
+        }
+    )
+    return pprov._encrypt(urlencode(fields))[0]
+
+
+class PaygateReply:
+    def __init__(self, data):
+        self.text = urlencode({"Data": data, "Len": len(data)})
+        self.status_code = 200
+
+
+class Paygate(ThreadingHTTPServer):
+    """
+    Local stand-in for a paygate endpoint. Answers with ``status`` after ``delay``
+    seconds and the body ``reply`` returns for the posted form, if given.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, status=200, delay=0, reply=None):
+        self.status = status
+        self.delay = delay
+        self.reply = reply
+        self.requests = []
+        self.forms = []
+        super().__init__(("127.0.0.1", 0), PaygateHandler)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/".format(self.server_address[1])
+
+
+class PaygateHandler(BaseHTTPRequestHandler):
+    def _reply(self, form=None):
+        self.server.requests.append((self.command, self.path))
+        time.sleep(self.server.delay)
+        body = b""
+        if form is not None and self.server.reply:
+            body = self.server.reply(form).encode()
+        self.send_response(self.server.status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        form = dict(parse_qsl(self.rfile.read(length).decode()))
+        self.server.forms.append(form)
+        self._reply(form)
+
+    def do_HEAD(self):
+        self._reply()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def paygates(settings):
+    """
+    Starts local paygate stand-ins, called with the arguments of ``Paygate``.
+    """
+    # pretix refuses connections to private addresses otherwise
+    settings.ALLOW_HTTP_TO_PRIVATE_NETWORKS = True
+    servers = []
+
+    def start(**kwargs):
+        server = Paygate(**kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(scope="session")
+def django_db_modify_db_settings(django_db_modify_db_settings_parallel_suffix):
+    # A replica alias that points to the test database, so tests can check which
+    # alias a query has been sent to.
+    from django.conf import settings
+
+    settings.DATABASES["replica"] = dict(
+        settings.DATABASES["default"], TEST={"MIRROR": "default"}
+    )
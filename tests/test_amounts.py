@@ -0,0 +1,74 @@
+import pytest
+import random
+from decimal import Decimal
+from django.conf import settings
+
+from pretix_computop.amounts import (
+    from_minor_units,
+    from_minor_units_many,
+    get_exponent,
+    to_minor_units,
+    to_minor_units_many,
+)
+
+EXAMPLES = 200
+
+# Every currency an event can use, most of them have no entry in CURRENCY_PLACES
+CURRENCIES = sorted(c.alpha_3 for c in settings.CURRENCIES)
+
+
+def random_split(rng, total, parts):
+    """
+    Splits ``total`` minor units into ``parts`` positive pieces, like a payment that
+    is refunded in several partial refunds.
+    """
+    cuts = sorted(rng.sample(range(1, total), parts - 1))
+    return [b - a for a, b in zip([0] + cuts, cuts + [total])]
+
+
+@pytest.mark.parametrize("currency", CURRENCIES)
+def test_payment_refund_settlement_round_trip(currency):
+    rng = random.Random(currency)
+    places = get_exponent(currency)
+    assert places == settings.CURRENCY_PLACES.get(currency, 2)
+
+    for i in range(EXAMPLES):
+        minor = rng.randint(1, 10**9)
+        # The order total as pretix stores it
+        amount = Decimal(minor).scaleb(-places).quantize(Decimal(1).scaleb(-places))
+
+        # Payment request
+        assert to_minor_units(amount, currency) == minor
+        assert to_minor_units(str(amount), currency) == minor
+
+        # Paygate response
+        assert from_minor_units(minor, currency) == amount
+        assert from_minor_units(str(minor), currency).as_tuple().exponent == -places
+
+        # Partial refunds, each converted on its own, settle to the payment amount
+        refunds = [
+            from_minor_units(m, currency)
+            for m in random_split(rng, minor, min(minor, rng.randint(1, 5)))
+        ]
+        assert sum(to_minor_units(r, currency) for r in refunds) == minor
+        assert sum(refunds) == amount
+
+        # Bulk variants agree with the single conversions
+        assert to_minor_units_many(refunds, currency) == [
+            to_minor_units(r, currency) for r in refunds
+        ]
+        assert from_minor_units_many(
+            to_minor_units_many(refunds, currency), currency
+        ) == refunds
+
+
+@pytest.mark.parametrize("currency", CURRENCIES)
+def test_fractions_of_minor_units_are_truncated(currency):
+    places = get_exponent(currency)
+    amount = Decimal("12").scaleb(-places) + Decimal("0.9").scaleb(-places)
+    assert to_minor_units(amount, currency) == 12
+
+
+def test_unknown_currency_uses_two_places():
+    assert to_minor_units(Decimal("13.37"), "XXX_UNKNOWN") == 1337
+    assert from_minor_units(1337, "XXX_UNKNOWN") == Decimal("13.37")
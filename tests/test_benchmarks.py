@@ -0,0 +1,206 @@
+"""
+Benchmarks of the callback handling, skipped unless COMPUTOP_BENCHMARKS is set, e.g.
+
+    COMPUTOP_BENCHMARKS=1 python -m pytest tests/test_benchmarks.py -s
+"""
+import asyncio
+import hashlib
+import os
+import pytest
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.db import connection, transaction
+from django.test import AsyncRequestFactory, RequestFactory
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderPayment
+from pretix.helpers import OF_SELF
+
+from pretix_computop.paymentmethods import get_provider_identifiers
+from pretix_computop.views import AsyncNotifyView, NotifyView
+
+from .conftest import get_provider, paygate_data
+
+pytestmark = pytest.mark.skipif(
+    not os.environ.get("COMPUTOP_BENCHMARKS"), reason="benchmarks are opt-in"
+)
+
+CONCURRENCY = 1000
+IDENTIFIERS = get_provider_identifiers("computop")
+
+
+def create_payments(order, provider, count):
+    with scopes_disabled():
+        return [
+            order.payments.create(
+                provider=provider,
+                amount=order.total,
+                state=OrderPayment.PAYMENT_STATE_CREATED,
+            )
+            for i in range(count)
+        ]
+
+
+def report(name, durations, elapsed):
+    durations = sorted(durations)
+    print(
+        "\n{}: {} callbacks in {:.2f}s ({:.0f}/s), p50 {:.1f}ms, p99 {:.1f}ms".format(
+            name,
+            len(durations),
+            elapsed,
+            len(durations) / elapsed,
+            durations[len(durations) // 2] * 1000,
+            durations[int(len(durations) * 0.99)] * 1000,
+        )
+    )
+
+
+def callback(factory, event, payment, pprov):
+    # Pending results exercise the whole path without marking the order as paid
+    request = factory.post(
+        "/", {"Data": paygate_data(pprov, payment.full_id, code="60000000")}
+    )
+    request.event = event
+    request.organizer = event.organizer
+    kwargs = {
+        "order": payment.order.code,
+        "hash": hashlib.sha1(payment.order.secret.lower().encode()).hexdigest(),
+        "payment": str(payment.pk),
+        "payment_provider": "computop",
+    }
+    return request, kwargs
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.skipif(
+    connection.vendor != "postgresql",
+    reason="concurrent callbacks need a PostgreSQL database",
+)
+def test_notify_concurrency(env):
+    """
+    Sends the same number of concurrent callbacks to the sync and the async notify
+    view, each against its own set of fresh payments of the same order.
+    """
+    event, order, payment = env
+    pprov = get_provider(payment)
+    sync_view = NotifyView.as_view(provider_identifiers=IDENTIFIERS)
+    async_view = AsyncNotifyView.as_view(provider_identifiers=IDENTIFIERS)
+
+    def post_sync(args):
+        request, kwargs = args
+        started = time.monotonic()
+        try:
+            with scopes_disabled():
+                response = sync_view(request, **kwargs)
+        finally:
+            connection.close()
+        assert response.status_code == 200
+        return time.monotonic() - started
+
+    callbacks = [
+        callback(RequestFactory(), event, p, pprov)
+        for p in create_payments(order, payment.provider, CONCURRENCY)
+    ]
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+        durations = list(executor.map(post_sync, callbacks))
+    report(
+        "sync notify, {} threads".format(CONCURRENCY),
+        durations,
+        time.monotonic() - started,
+    )
+
+    async def post_async(args):
+        request, kwargs = args
+        started = time.monotonic()
+        with scopes_disabled():
+            response = await async_view(request, **kwargs)
+        assert response.status_code == 200
+        return time.monotonic() - started
+
+    async def run(callbacks):
+        return await asyncio.gather(*(post_async(c) for c in callbacks))
+
+    callbacks = [
+        callback(AsyncRequestFactory(), event, p, pprov)
+        for p in create_payments(order, payment.provider, CONCURRENCY)
+    ]
+    started = time.monotonic()
+    durations = asyncio.run(run(callbacks))
+    report(
+        "async notify, {} concurrent".format(CONCURRENCY),
+        durations,
+        time.monotonic() - started,
+    )
+
+    with scopes_disabled():
+        assert (
+            order.payments.filter(state=OrderPayment.PAYMENT_STATE_PENDING).count()
+            == 2 * CONCURRENCY
+        )
+
+
+@pytest.mark.django_db
+def test_payment_lookup(env):
+    """
+    Times the locked payment lookup of the callback views with the exact provider
+    identifiers against the case-insensitive prefix match used before.
+    """
+    event, order, payment = env
+    with scopes_disabled():
+        OrderPayment.objects.bulk_create(
+            [
+                OrderPayment(
+                    order=order,
+                    local_id=i + 2,
+                    provider="manual" if i % 2 else payment.provider,
+                    amount=payment.amount,
+                    state=OrderPayment.PAYMENT_STATE_CREATED,
+                )
+                for i in range(20000)
+            ]
+        )
+
+        view = NotifyView(provider_identifiers=IDENTIFIERS)
+        view.request = RequestFactory().post("/")
+        view.request.event = event
+        view.kwargs = {"payment": payment.pk}
+
+        def lookup_in():
+            view.order = order
+            return view.get_payment_for_update()
+
+        def lookup_istartswith():
+            return (
+                OrderPayment.objects.select_for_update(of=OF_SELF)
+                .select_related("order")
+                .get(
+                    pk=payment.pk,
+                    order_id=order.pk,
+                    provider__istartswith="computop",
+                )
+            )
+
+        lookups = {
+            "provider__in": (
+                lookup_in,
+                OrderPayment.objects.filter(
+                    pk=payment.pk, order_id=order.pk, provider__in=IDENTIFIERS
+                ),
+            ),
+            "provider__istartswith": (
+                lookup_istartswith,
+                OrderPayment.objects.filter(
+                    pk=payment.pk, order_id=order.pk, provider__istartswith="computop"
+                ),
+            ),
+        }
+        for name, (lookup, qs) in lookups.items():
+            started = time.monotonic()
+            for i in range(1000):
+                with transaction.atomic():
+                    assert lookup().pk == payment.pk
+            print(
+                "\n{}: {:.3f}ms per lookup\n{}".format(
+                    name, time.monotonic() - started, qs.explain()
+                )
+            )
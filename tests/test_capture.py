@@ -0,0 +1,207 @@
+import json
+import pytest
+from django.core.management import call_command
+from django_scopes import scopes_disabled
+from pretix.base.models import Order, OrderPayment
+from urllib.parse import parse_qsl, urlencode
+
+from pretix_computop.capture import capture_payments, get_authorized_payments
+from pretix_computop.response import INFO_VERSION, load_info
+
+from .conftest import PAY_ID, callback_url, get_provider, paygate_data
+
+# The test database doesn't support concurrent writes, the captures still go
+# through the thread pool.
+WORKERS = 1
+
+
+def authorize(order, count):
+    """
+    Creates orders like ``order``, each with a credit card payment that has been
+    authorized with manual capture.
+    """
+    payments = []
+    for i in range(count):
+        o = Order.objects.create(
+            code="AUTH{}".format(i),
+            event=order.event,
+            email=order.email,
+            status=Order.STATUS_PENDING,
+            datetime=order.datetime,
+            expires=order.expires,
+            total=order.total,
+            locale=order.locale,
+            sales_channel=order.sales_channel,
+        )
+        payments.append(
+            o.payments.create(
+                provider="computop_CC",
+                amount=o.total,
+                state=OrderPayment.PAYMENT_STATE_PENDING,
+                info=json.dumps(
+                    {
+                        "_v": INFO_VERSION,
+                        "PayID": PAY_ID,
+                        "Status": "AUTHORIZED",
+                        "Code": "00000000",
+                        "Capture": "MANUAL",
+                    }
+                ),
+            )
+        )
+    return payments
+
+
+def capture_reply(pprov, codes=None):
+    """
+    Answers capture requests like the paygate, with the result code ``codes`` holds
+    for the transaction or success.
+    """
+
+    codes = {} if codes is None else codes
+
+    def reply(form):
+        request = dict(parse_qsl(pprov._decrypt(form["Data"])))
+        code = codes.get(request["TransID"], "00000000")
+        data = paygate_data(pprov, request["TransID"], code=code)
+        return urlencode({"Data": data, "Len": len(data)})
+
+    return reply
+
+
+@pytest.mark.django_db(transaction=True)
+def test_authorized_payments_are_captured(env, paygates):
+    event, order, payment = env
+    pprov = get_provider(payment)
+    with scopes_disabled():
+        payments = authorize(order, 5)
+        assert set(get_authorized_payments()) == set(payments)
+    paygate = paygates(reply=capture_reply(pprov))
+
+    outcomes = capture_payments(
+        [p.pk for p in payments], workers=WORKERS, rate=0, url=paygate.url
+    )
+
+    assert outcomes == {"captured": 5}
+    assert sorted(
+        dict(parse_qsl(pprov._decrypt(f["Data"])))["TransID"] for f in paygate.forms
+    ) == sorted(p.full_id for p in payments)
+    with scopes_disabled():
+        for p in payments:
+            p.refresh_from_db()
+            assert p.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+            assert p.order.status == Order.STATUS_PAID
+            assert load_info(p)["Capture"] == "MANUAL"
+            assert "CaptureRequested" not in load_info(p)
+        assert not get_authorized_payments().exists()
+
+    # Nothing is captured twice
+    assert capture_payments(
+        [p.pk for p in payments], workers=WORKERS, rate=0, url=paygate.url
+    ) == {"skipped": 5}
+    assert len(paygate.forms) == 5
+
+
+@pytest.mark.django_db(transaction=True)
+def test_partial_failures(env, paygates):
+    event, order, payment = env
+    pprov = get_provider(payment)
+    with scopes_disabled():
+        captured, failed, transient, broken = authorize(order, 4)
+    codes = {failed.full_id: "21000000", transient.full_id: "60000000"}
+    paygate = paygates(reply=capture_reply(pprov, codes))
+    unreachable = paygates(status=500)
+
+    ids = [captured.pk, failed.pk, transient.pk]
+    outcomes = capture_payments(ids, workers=WORKERS, rate=0, url=paygate.url)
+    outcomes += capture_payments([broken.pk], workers=WORKERS, rate=0, url=unreachable.url)
+
+    assert outcomes == {"captured": 1, "failed": 1, "transient": 1, "error": 1}
+    with scopes_disabled():
+        for p in (captured, failed, transient, broken):
+            p.refresh_from_db()
+    assert captured.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+    assert failed.state == OrderPayment.PAYMENT_STATE_FAILED
+
+    # A transient reply leaves the payment for the next run
+    assert transient.state == OrderPayment.PAYMENT_STATE_PENDING
+    assert load_info(transient)["CaptureCode"] == "60000000"
+    assert "CaptureRequested" not in load_info(transient)
+
+    # Without a reply, the paygate may have captured the payment, it is not sent
+    # again unless asked for
+    assert broken.state == OrderPayment.PAYMENT_STATE_PENDING
+    assert "CaptureRequested" in load_info(broken)
+    del codes[transient.full_id]
+    ids = [transient.pk, broken.pk]
+    assert capture_payments(ids, workers=WORKERS, rate=0, url=paygate.url) == {
+        "captured": 1,
+        "unconfirmed": 1,
+    }
+    assert capture_payments(
+        [broken.pk], workers=WORKERS, rate=0, url=paygate.url, retry_requested=True
+    ) == {"captured": 1}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_authorized_notify_is_captured(env, client, paygates):
+    event, order, payment = env
+    event.settings.set("payment_computop_method_CC_capture_manual", True)
+    pprov = get_provider(payment)
+    with scopes_disabled():
+        pprov.execute_payment(None, payment)
+
+    data = paygate_data(pprov, payment.full_id, status="AUTHORIZED")
+    client.post(callback_url("notify", payment), {"Data": data})
+    with scopes_disabled():
+        payment.refresh_from_db()
+        assert payment.state == OrderPayment.PAYMENT_STATE_PENDING
+        assert list(get_authorized_payments()) == [payment]
+
+    paygate = paygates(reply=capture_reply(pprov))
+    assert capture_payments(
+        [payment.pk], workers=WORKERS, rate=0, url=paygate.url
+    ) == {"captured": 1}
+    with scopes_disabled():
+        payment.refresh_from_db()
+        assert payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+        assert payment.order.status == Order.STATUS_PAID
+
+
+@pytest.mark.django_db(transaction=True)
+def test_direct_debits_are_submitted_by_the_capture(env, client, paygates):
+    event, order, payment = env
+    event.settings.set("payment_computop_method_EDD", True)
+    event.settings.set("payment_computop_method_EDD_capture_manual", True)
+    with scopes_disabled():
+        payment.provider = "computop_EDD"
+        payment.save(update_fields=["provider"])
+        card = authorize(order, 1)[0]
+    pprov = get_provider(payment)
+    with scopes_disabled():
+        pprov.execute_payment(None, payment)
+
+    data = paygate_data(pprov, payment.full_id, status="AUTHORIZED")
+    client.post(callback_url("notify", payment), {"Data": data})
+    paygate = paygates(reply=capture_reply(pprov))
+
+    # Manual capture of only the direct debits
+    call_command(
+        "computop_capture",
+        "--method=EDD",
+        "--workers={}".format(WORKERS),
+        "--rate=0",
+        "--paygate-url={}".format(paygate.url),
+    )
+
+    (form,) = paygate.forms
+    request = dict(parse_qsl(pprov._decrypt(form["Data"])))
+    assert request["TransID"] == payment.full_id
+    assert request["MandateID"] == payment.full_id
+    assert request["DtOfSgntr"] == payment.created.strftime("%d.%m.%Y")
+    assert request["MdtSeqType"] == "OOFF"
+    with scopes_disabled():
+        payment.refresh_from_db()
+        card.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+    assert card.state == OrderPayment.PAYMENT_STATE_PENDING
@@ -0,0 +1,115 @@
+import json
+import pytest
+import requests
+from decimal import Decimal
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderPayment, OrderRefund
+
+from pretix_computop import codes
+from pretix_computop.coalesce import flush_refunds
+from pretix_computop.response import INFO_VERSION, ComputopResponse
+
+from .conftest import PAY_ID, get_provider
+
+
+@pytest.fixture
+def queued(env):
+    event, order, payment = env
+    with scopes_disabled():
+        payment.info_data = {"_v": INFO_VERSION, "PayID": PAY_ID}
+        payment.state = OrderPayment.PAYMENT_STATE_CONFIRMED
+        payment.save()
+        refunds = [
+            order.refunds.create(
+                payment=payment,
+                provider=payment.provider,
+                source=OrderRefund.REFUND_SOURCE_ADMIN,
+                state=OrderRefund.REFUND_STATE_TRANSIT,
+                amount=Decimal("1.00"),
+                info='{"_v": 2, "PayID": "%s", "Coalesce": true}' % PAY_ID,
+            )
+            for i in range(3)
+        ]
+    return get_provider(payment), refunds
+
+
+def fake_credit(combined_code=None, failing=()):
+    def send_credit(self, data):
+        if data["TransID"].endswith("-C"):
+            if combined_code is None:
+                raise requests.ConnectionError("timeout")
+            code = combined_code
+        elif data["TransID"] in failing:
+            raise KeyError("Data")
+        else:
+            code = "00000000"
+        send_credit.sent.append(data["TransID"])
+        return ComputopResponse(PayID=PAY_ID, TransID=data["TransID"], Code=code)
+
+    send_credit.sent = []
+    return send_credit
+
+
+def states(refunds):
+    with scopes_disabled():
+        return [OrderRefund.objects.get(pk=r.pk).state for r in refunds]
+
+
+@pytest.mark.django_db
+def test_combined_transport_error_is_not_sent_again(queued, monkeypatch):
+    pprov, refunds = queued
+    send_credit = fake_credit()
+    monkeypatch.setattr(type(pprov), "_send_credit", send_credit)
+
+    with scopes_disabled():
+        flush_refunds(pprov, [r.pk for r in refunds])
+
+    assert send_credit.sent == []
+    assert states(refunds) == [OrderRefund.REFUND_STATE_FAILED] * 3
+    with scopes_disabled():
+        assert "check" in OrderRefund.objects.get(pk=refunds[0].pk).info
+
+
+@pytest.mark.django_db
+def test_combined_error_falls_back_to_single_refunds(queued, monkeypatch):
+    pprov, refunds = queued
+    send_credit = fake_credit(combined_code="29999999", failing=(refunds[1].full_id,))
+    monkeypatch.setattr(type(pprov), "_send_credit", send_credit)
+
+    with scopes_disabled():
+        flush_refunds(pprov, [r.pk for r in refunds])
+
+    assert send_credit.sent == [
+        "{}-C".format(refunds[0].full_id),
+        refunds[0].full_id,
+        refunds[2].full_id,
+    ]
+    assert states(refunds) == [
+        OrderRefund.REFUND_STATE_DONE,
+        OrderRefund.REFUND_STATE_FAILED,
+        OrderRefund.REFUND_STATE_DONE,
+    ]
+
+
+@pytest.mark.django_db
+def test_combined_decline_is_not_sent_again(queued, monkeypatch, tmp_path):
+    pprov, refunds = queued
+    catalogue = tmp_path / "codes.json"
+    catalogue.write_text(
+        json.dumps(
+            [{"code": "21234567", "category": "declined", "retryable": False}]
+        )
+    )
+    monkeypatch.setattr(codes, "CATALOGUE_FILE", str(catalogue))
+    codes._get_index.cache_clear()
+    send_credit = fake_credit(combined_code="21234567")
+    monkeypatch.setattr(type(pprov), "_send_credit", send_credit)
+
+    try:
+        with scopes_disabled():
+            flush_refunds(pprov, [r.pk for r in refunds])
+    finally:
+        codes._get_index.cache_clear()
+
+    assert send_credit.sent == ["{}-C".format(refunds[0].full_id)]
+    assert states(refunds) == [OrderRefund.REFUND_STATE_FAILED] * 3
@@ -0,0 +1,62 @@
+import json
+import pytest
+from django.core.exceptions import ImproperlyConfigured
+
+from pretix_computop import codes
+
+
+@pytest.fixture
+def catalogue(tmp_path, monkeypatch):
+    def write(entries):
+        path = tmp_path / "codes.json"
+        path.write_text(json.dumps(entries))
+        monkeypatch.setattr(codes, "CATALOGUE_FILE", str(path))
+        codes._get_index.cache_clear()
+
+    yield write
+    codes._get_index.cache_clear()
+
+
+def entry(code, category, retryable=False, **kwargs):
+    return dict(code=code, category=category, retryable=retryable, **kwargs)
+
+
+def test_lookup_order(catalogue):
+    catalogue(
+        [
+            entry("21234567", codes.CATEGORY_DECLINED, description="exact"),
+            entry("2123", codes.CATEGORY_FATAL),
+        ]
+    )
+    exact = codes.get_result_code("21234567")
+    assert exact.category == codes.CATEGORY_DECLINED
+    assert exact.description == "exact"
+    assert exact.action == codes.ACTION_FAIL
+    assert exact.message == codes.CATEGORIES[codes.CATEGORY_DECLINED][1]
+    assert codes.get_result_code("21239999").category == codes.CATEGORY_FATAL
+    assert codes.get_result_code("21249999").category == codes.CATEGORY_ERROR
+    assert codes.get_result_code("x") is codes.UNKNOWN_RESULT
+
+
+def test_packaged_catalogue():
+    codes._get_index.cache_clear()
+    codes.check_catalogue()
+    assert codes.get_result_code("00000000").action == codes.ACTION_CONFIRM
+    # Errors are not declines, only cataloged codes are
+    assert codes.get_result_code("29999999").category == codes.CATEGORY_ERROR
+
+
+@pytest.mark.parametrize(
+    "bad",
+    [
+        entry("212", codes.CATEGORY_ERROR),
+        entry("2123456x", codes.CATEGORY_ERROR),
+        entry("21234567", "unknown"),
+        entry("21234567", codes.CATEGORY_ERROR, retryable="yes"),
+        entry("21234567", codes.CATEGORY_DECLINED, retryable=True),
+    ],
+)
+def test_invalid_catalogue(catalogue, bad):
+    catalogue([bad])
+    with pytest.raises(ImproperlyConfigured):
+        codes.check_catalogue()
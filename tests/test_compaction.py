@@ -0,0 +1,90 @@
+import json
+import pytest
+from django.core.management import call_command
+from django_scopes import scopes_disabled
+from io import StringIO
+from pretix.base.models import OrderPayment, OrderRefund
+
+from pretix_computop.compaction import compact_stored_info
+from pretix_computop.response import INFO_VERSION
+
+LEGACY_INFO = {
+    "mid": "TESTMID",
+    "PayID": "abc",
+    "TransID": "P-1",
+    "Status": "OK",
+    "Code": "00000000",
+    "MAC": "1234",
+    "Amount": "1337",
+}
+COMPACT_INFO = {
+    "_v": INFO_VERSION,
+    "PayID": "abc",
+    "TransID": "P-1",
+    "Status": "OK",
+    "Code": "00000000",
+}
+
+
+@pytest.fixture
+def rows(env):
+    event, order, payment = env
+    with scopes_disabled():
+        payment.state = OrderPayment.PAYMENT_STATE_CONFIRMED
+        payment.info = json.dumps(LEGACY_INFO)
+        payment.save()
+        compact = order.payments.create(
+            provider="computop_CC",
+            amount=order.total,
+            state=OrderPayment.PAYMENT_STATE_FAILED,
+            info=json.dumps(dict(COMPACT_INFO, Code="21000000")),
+        )
+        other = order.payments.create(
+            provider="manual",
+            amount=order.total,
+            state=OrderPayment.PAYMENT_STATE_CONFIRMED,
+            info=json.dumps(LEGACY_INFO),
+        )
+        refund = order.refunds.create(
+            payment=payment,
+            provider="computop_CC",
+            amount=order.total,
+            state=OrderRefund.REFUND_STATE_DONE,
+            source=OrderRefund.REFUND_SOURCE_ADMIN,
+            info=json.dumps(LEGACY_INFO),
+        )
+    return payment, compact, other, refund
+
+
+def reload(*rows):
+    with scopes_disabled():
+        for row in rows:
+            row.refresh_from_db()
+    return [row.info_data for row in rows]
+
+
+@pytest.mark.django_db
+def test_legacy_rows_are_compacted(rows):
+    payment, compact, other, refund = rows
+
+    compacted, elapsed = compact_stored_info(batch_size=1)
+
+    assert compacted == 2
+    assert reload(payment, compact, other, refund) == [
+        COMPACT_INFO,
+        dict(COMPACT_INFO, Code="21000000"),
+        LEGACY_INFO,
+        COMPACT_INFO,
+    ]
+    assert compact_stored_info()[0] == 0
+
+
+@pytest.mark.django_db
+def test_command(rows):
+    payment, compact, other, refund = rows
+    out = StringIO()
+
+    call_command("computop_compact_info", "--batch-size=10", stdout=out)
+
+    assert out.getvalue().startswith("Compacted 2 rows in ")
+    assert reload(payment, refund) == [COMPACT_INFO, COMPACT_INFO]
@@ -0,0 +1,114 @@
+import pytest
+import requests
+import socket
+import threading
+import time
+from unittest import mock
+
+from pretix_computop import endpoints
+from pretix_computop.endpoints import EndpointPool
+
+
+@pytest.fixture
+def unreachable(settings):
+    settings.ALLOW_HTTP_TO_PRIVATE_NETWORKS = True
+    # A port nothing listens on
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    return "http://127.0.0.1:{}/".format(port)
+
+
+def make_pool(*urls):
+    pool = EndpointPool("computop", urls, probe_interval=3600)
+    # Only the tests start probes
+    pool.last_probe = time.monotonic()
+    return pool
+
+
+def test_fails_over_after_an_error_response(paygates):
+    broken, working = paygates(status=503), paygates()
+    pool = make_pool(broken.url, working.url)
+
+    assert pool.post("credit.aspx").status_code == 503
+    assert pool.post("credit.aspx").status_code == 200
+    assert pool.post("credit.aspx").status_code == 200
+    assert broken.requests == [("POST", "/credit.aspx")]
+    assert working.requests == [("POST", "/credit.aspx")] * 2
+
+
+def test_failed_requests_are_not_retried(paygates, unreachable):
+    working = paygates()
+    pool = make_pool(unreachable, working.url)
+
+    with pytest.raises(requests.ConnectionError):
+        pool.post("credit.aspx")
+    assert working.requests == []
+
+    assert pool.post("credit.aspx").status_code == 200
+    assert working.requests == [("POST", "/credit.aspx")]
+
+
+def test_timeout(paygates, monkeypatch):
+    slow, working = paygates(delay=1), paygates()
+    pool = make_pool(slow.url, working.url)
+    monkeypatch.setattr(endpoints, "REQUEST_TIMEOUT", 0.2)
+
+    started = time.monotonic()
+    with pytest.raises(requests.Timeout):
+        pool.post("credit.aspx")
+    assert time.monotonic() - started < 1
+
+    assert pool.select() == working.url
+
+
+def test_lowest_latency_wins(paygates):
+    slow, fast = paygates(delay=0.1), paygates()
+    pool = make_pool(slow.url, fast.url)
+
+    assert pool.select() == slow.url
+    pool.probe()
+    assert pool.select() == fast.url
+
+
+def test_probe_recovers_endpoints(paygates):
+    first, second = paygates(status=500), paygates()
+    pool = make_pool(first.url, second.url)
+
+    pool.probe()
+    assert pool.select() == second.url
+    assert first.requests == [("HEAD", "/")]
+
+    first.status = 200
+    pool.report(second.url, error=True)
+    pool.probe()
+    assert all(e.healthy for e in pool.endpoints)
+
+
+def test_all_endpoints_failing(unreachable):
+    pool = make_pool(unreachable, unreachable.replace("127.0.0.1", "localhost"))
+    pool.probe()
+    assert pool.select() == unreachable
+
+
+def test_concurrent_selections_switch_once(paygates):
+    first, second = paygates(), paygates()
+    pool = make_pool(first.url, second.url)
+    pool.report(first.url, error=True)
+
+    barrier = threading.Barrier(20)
+    selected = []
+
+    def select():
+        barrier.wait()
+        selected.append(pool.select())
+
+    with mock.patch.object(endpoints.logger, "warning") as warning:
+        threads = [threading.Thread(target=select) for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    assert selected == [second.url] * 20
+    assert warning.call_count == 1
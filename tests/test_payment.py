@@ -0,0 +1,53 @@
+import pytest
+from datetime import timedelta
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderPayment
+from unittest import mock
+
+from pretix_computop.payment import SESSION_REUSE_TIMEOUT
+from pretix_computop.response import load_info
+
+from .conftest import get_provider
+
+
+def execute(payment):
+    # pretix loads the payment again for every request
+    payment = OrderPayment.objects.get(pk=payment.pk)
+    pprov = get_provider(payment)
+    with mock.patch.object(pprov, "_encrypt", wraps=pprov._encrypt) as encrypt:
+        url = pprov.execute_payment(None, payment)
+    return url, encrypt.call_count
+
+
+@pytest.mark.django_db
+def test_repeated_execution_reuses_the_session(env):
+    event, order, payment = env
+    with scopes_disabled():
+        url, encrypted = execute(payment)
+        assert encrypted == 1
+
+        # The customer comes back from the paygate and confirms the payment again
+        again, encrypted = execute(payment)
+        assert encrypted == 0
+        assert again == url
+        assert order.payments.count() == 1
+
+
+@pytest.mark.django_db
+def test_expired_session_is_not_reused(env):
+    event, order, payment = env
+    with scopes_disabled():
+        execute(payment)
+        payment.refresh_from_db()
+        info = payment.info_data
+        info["Session"]["Created"] = (
+            now() - timedelta(seconds=SESSION_REUSE_TIMEOUT + 1)
+        ).isoformat()
+        payment.info_data = info
+        payment.save(update_fields=["info"])
+
+        url, encrypted = execute(payment)
+        assert encrypted == 1
+        payment.refresh_from_db()
+        assert load_info(payment)["Session"]["Created"] != info["Session"]["Created"]
@@ -0,0 +1,104 @@
+import json
+import os
+import pytest
+import threading
+import time
+
+from pretix_computop import profiling
+from pretix_computop.profiling import profiled, sampler
+
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    config = {
+        "threshold": 0.02,
+        "interval": 0.001,
+        "keep": 100,
+        "directory": str(tmp_path),
+    }
+    monkeypatch.setattr(profiling, "get_config", lambda: config)
+    return config
+
+
+def profiles(config):
+    return sorted(p for p in os.listdir(config["directory"]) if p.endswith(".folded"))
+
+
+@profiled("slow")
+def slow_call(duration=0.05):
+    time.sleep(duration)
+    return "result"
+
+
+def test_slow_call_is_written(config):
+    assert slow_call() == "result"
+
+    (folded,) = profiles(config)
+    with open(os.path.join(config["directory"], folded)) as f:
+        stacks = f.read().splitlines()
+    assert stacks
+    assert any("test_profiling.py:slow_call" in s for s in stacks)
+    with open(
+        os.path.join(config["directory"], folded[: -len(".folded")] + ".json")
+    ) as f:
+        summary = json.load(f)
+    assert summary["name"] == "slow"
+    assert summary["duration"] >= 0.05
+    assert summary["samples"] == sum(int(s.rsplit(" ", 1)[1]) for s in stacks)
+
+
+def test_fast_call_is_not_written(config):
+    assert slow_call(0) == "result"
+    assert profiles(config) == []
+
+
+def test_disabled(config):
+    config["threshold"] = 0
+    slow_call()
+    assert profiles(config) == []
+
+
+def test_nested_calls_are_written_once(config):
+    @profiled("outer")
+    def outer():
+        return slow_call()
+
+    assert outer() == "result"
+    (folded,) = profiles(config)
+    assert "-outer-" in folded
+
+
+@pytest.mark.parametrize("keep", [0, 1, 2])
+def test_only_the_newest_profiles_are_kept(config, keep):
+    config["keep"] = keep
+    for i in range(3):
+        slow_call(0.03)
+    assert len(profiles(config)) == keep
+    assert len(os.listdir(config["directory"])) == 2 * keep
+
+
+def test_write_errors_do_not_break_the_call(config, monkeypatch):
+    def broken(*args):
+        raise ValueError("broken")
+
+    monkeypatch.setattr(profiling, "_write_profile", broken)
+    assert slow_call() == "result"
+
+
+def test_samples_are_final_after_stop(monkeypatch):
+    fold = profiling._fold
+
+    def slow_fold(frame):
+        # Makes a sampling round overlap with stop()
+        time.sleep(0.002)
+        return fold(frame)
+
+    monkeypatch.setattr(profiling, "_fold", slow_fold)
+    thread_id = threading.get_ident()
+    for i in range(20):
+        samples = sampler.start(thread_id, 0)
+        time.sleep(0.001)
+        assert sampler.stop(thread_id) is samples
+        taken = dict(samples)
+        time.sleep(0.005)
+        assert dict(samples) == taken
@@ -0,0 +1,85 @@
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderPayment, OrderRefund
+
+from pretix_computop.endpoints import EndpointPool
+
+from .conftest import PaygateReply, callback_url, get_provider, paygate_data
+
+# Query budgets of the plugin's entry points, measured against pretix 2026.8 with
+# its test settings, which don't cache event settings. Most of the callback budget
+# is pretix' own work of marking the order as paid. Lower them when they can be
+# lowered, raise them only together with a reason.
+EXECUTE_PAYMENT_QUERIES = 16
+CALLBACK_QUERIES = {"notify": 174, "return": 176}
+EXECUTE_REFUND_QUERIES = 26
+
+
+def count_updates(queries, table):
+    return sum(
+        1 for q in queries if q["sql"].startswith('UPDATE "{}"'.format(table))
+    )
+
+
+@pytest.mark.django_db
+def test_execute_payment(env, django_assert_max_num_queries):
+    event, order, payment = env
+    pprov = get_provider(payment)
+    pprov.settings.get("merchant_id")
+
+    with scopes_disabled(), CaptureQueriesContext(connection) as ctx:
+        with django_assert_max_num_queries(EXECUTE_PAYMENT_QUERIES):
+            url = pprov.execute_payment(None, payment)
+
+    assert url.startswith("https://www.computop-paygate.com/payssl.aspx?")
+    assert count_updates(ctx.captured_queries, "pretixbase_orderpayment") == 1
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("view", ["notify", "return"])
+def test_callback_confirms_with_single_update(
+    env, client, view, django_assert_max_num_queries
+):
+    event, order, payment = env
+    pprov = get_provider(payment)
+    data = paygate_data(pprov, payment.full_id)
+
+    with CaptureQueriesContext(connection) as ctx:
+        with django_assert_max_num_queries(CALLBACK_QUERIES[view]):
+            client.post(callback_url(view, payment), {"Data": data})
+
+    with scopes_disabled():
+        payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+    assert count_updates(ctx.captured_queries, "pretixbase_orderpayment") == 1
+
+
+@pytest.mark.django_db
+def test_execute_refund(env, monkeypatch, django_assert_max_num_queries):
+    event, order, payment = env
+    pprov = get_provider(payment)
+    with scopes_disabled():
+        payment.info_data = {"_v": 2, "PayID": "0123456789abcdef0123456789abcdef"}
+        payment.state = OrderPayment.PAYMENT_STATE_CONFIRMED
+        payment.save()
+        refund = order.refunds.create(
+            payment=payment,
+            provider=payment.provider,
+            source=OrderRefund.REFUND_SOURCE_ADMIN,
+            state=OrderRefund.REFUND_STATE_CREATED,
+            amount=payment.amount,
+        )
+    monkeypatch.setattr(
+        EndpointPool,
+        "post",
+        lambda self, path, **kwargs: PaygateReply(paygate_data(pprov, refund.full_id)),
+    )
+
+    with scopes_disabled(), CaptureQueriesContext(connection) as ctx:
+        with django_assert_max_num_queries(EXECUTE_REFUND_QUERIES):
+            pprov.execute_refund(refund)
+
+    assert refund.state == OrderRefund.REFUND_STATE_DONE
+    assert count_updates(ctx.captured_queries, "pretixbase_orderrefund") == 1
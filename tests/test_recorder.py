@@ -0,0 +1,80 @@
+import pytest
+from django.core import mail
+from django.core.management import call_command
+from django.test import RequestFactory
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderPayment
+
+from pretix_computop import recorder
+from pretix_computop.response import ComputopResponse
+
+from .conftest import PAY_ID
+
+
+@pytest.fixture
+def recording(monkeypatch, settings):
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    }
+    monkeypatch.setattr(recorder, "is_enabled", lambda: True)
+    monkeypatch.setattr(recorder, "get_size", lambda: 3)
+    recorder.clear_recording()
+    yield
+    recorder.clear_recording()
+
+
+def record(event, order, payment, **fields):
+    request = RequestFactory().post("/")
+    request.organizer = event.organizer
+    request.event = event
+    fields.setdefault("PayID", PAY_ID)
+    response = ComputopResponse(
+        mid="TESTMID",
+        TransID=payment.full_id,
+        Status="OK",
+        Code="00000000",
+        MAC="X",
+        **fields
+    )
+    recorder.record_callback(
+        request, order, payment.pk, "notify_view", response, True, 100, 0.01
+    )
+
+
+@pytest.mark.django_db
+def test_ring_keeps_latest_redacted_callbacks(env, recording):
+    event, order, payment = env
+    order.testmode = False
+
+    for i in range(5):
+        record(event, order, payment, PayID=str(i))
+
+    records = recorder.get_recording()
+    assert [r["fields"]["PayID"] for r in records] == ["2", "3", "4"]
+    assert all("MAC" not in r["fields"] and "mid" not in r["fields"] for r in records)
+    assert records[0]["testmode"] is False
+
+
+@pytest.mark.django_db
+def test_recording_is_best_effort(env, monkeypatch):
+    event, order, payment = env
+    monkeypatch.setattr(recorder, "is_enabled", lambda: True)
+
+    def broken(*args, **kwargs):
+        raise ConnectionError("cache is down")
+
+    monkeypatch.setattr(recorder.cache, "set", broken)
+    record(event, order, payment)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_replay_sends_no_mail(env, recording):
+    event, order, payment = env
+    record(event, order, payment)
+
+    call_command("computop_replay", speed=0, workers=1)
+
+    with scopes_disabled():
+        payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+    assert mail.outbox == []
@@ -0,0 +1,95 @@
+import json
+import pytest
+
+from pretix_computop.response import (
+    INFO_VERSION,
+    PERSISTED_FIELDS,
+    ComputopResponse,
+    compact_info,
+    load_info,
+)
+
+PAYLOAD = (
+    "mid=TESTMID&PayID=abc&XID=def&TransID=P-1&Status=OK&Code=00000000"
+    "&Description=Request+successful&MAC=1234&pt=CC&CCBrand=VISA"
+    "&Amount=1337&URLNotify=https%3A%2F%2Fexample.org%2Fnotify%2F&refnr=&Empty"
+)
+
+
+def test_parse():
+    response = ComputopResponse.parse(PAYLOAD)
+    assert response["mid"] == "TESTMID"
+    assert response["Description"] == "Request successful"
+    assert response["Amount"] == "1337"
+    assert response["URLNotify"] == "https://example.org/notify/"
+    # Pairs without a value are dropped
+    assert "refnr" not in response
+    assert "Empty" not in response
+    assert response.get("refnr", "default") == "default"
+    with pytest.raises(KeyError):
+        response["Capture"]
+    assert response.extra == {
+        "Amount": "1337",
+        "URLNotify": "https://example.org/notify/",
+    }
+
+
+def test_to_dict_keeps_everything_for_the_log():
+    d = ComputopResponse.parse(PAYLOAD).to_dict()
+    assert d["MAC"] == "1234"
+    assert d["mid"] == "TESTMID"
+    assert d["Amount"] == "1337"
+
+
+def test_only_whitelisted_fields_are_persisted():
+    info = ComputopResponse.parse(PAYLOAD).to_info()
+    assert info == {
+        "_v": INFO_VERSION,
+        "PayID": "abc",
+        "XID": "def",
+        "TransID": "P-1",
+        "Status": "OK",
+        "Code": "00000000",
+        "Description": "Request successful",
+        "pt": "CC",
+        "CCBrand": "VISA",
+    }
+    assert set(info) - {"_v"} <= set(PERSISTED_FIELDS)
+
+
+def test_compact_outgoing_request():
+    request = {
+        "MerchantID": "TESTMID",
+        "TransID": "P-1",
+        "Amount": 1337,
+        "MAC": "1234",
+        "URLNotify": "https://example.org/notify/",
+        "Capture": "MANUAL",
+        "Description": "Payment process initiated but not completed",
+    }
+    assert compact_info(request) == {
+        "_v": INFO_VERSION,
+        "TransID": "P-1",
+        "Capture": "MANUAL",
+        "Description": "Payment process initiated but not completed",
+    }
+
+
+class Row:
+    def __init__(self, info):
+        self.info = json.dumps(info)
+
+    @property
+    def info_data(self):
+        return json.loads(self.info)
+
+
+def test_load_info_compacts_legacy_rows():
+    row = Row(ComputopResponse.parse(PAYLOAD).to_dict())
+    info = load_info(row)
+    assert info == ComputopResponse.parse(PAYLOAD).to_info()
+    # Parsed once for as long as the info is unchanged
+    assert load_info(row) is info
+
+    row.info = json.dumps({"_v": INFO_VERSION, "Code": "21000000"})
+    assert load_info(row) == {"_v": INFO_VERSION, "Code": "21000000"}
@@ -0,0 +1,88 @@
+import pytest
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.db import connections
+from django.test.utils import CaptureQueriesContext
+
+from pretix_computop import routing
+from pretix_computop.routing import get_read_db, mark_written
+
+from .conftest import callback_url, get_provider, paygate_data
+
+
+@pytest.fixture
+def replica(settings, monkeypatch):
+    # Configured like pretix does when the config has a replica section
+    settings.DATABASE_REPLICA = "replica"
+    settings.DATABASE_ROUTERS = ["pretix.helpers.database.ReplicaRouter"]
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    }
+    # The local memory cache stands in for a shared cache here
+    monkeypatch.setattr(routing, "LOCAL_CACHE_BACKENDS", (DummyCache,))
+    cache.clear()
+    yield
+    cache.clear()
+
+
+def test_without_replica():
+    assert get_read_db() == "default"
+    assert get_read_db(1, "FOOBAR") == "default"
+
+
+@pytest.mark.django_db
+def test_recently_written_orders_are_read_from_primary(env, replica):
+    event, order, payment = env
+    assert get_read_db() == "replica"
+    assert get_read_db(event.pk, order.code) == "replica"
+
+    mark_written(order)
+
+    assert get_read_db(event.pk, order.code) == "default"
+    assert get_read_db(event.pk, "OTHER") == "replica"
+    assert get_read_db() == "replica"
+
+
+def test_orders_are_read_from_primary_without_shared_cache(settings):
+    settings.DATABASE_REPLICA = "replica"
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}
+    }
+    assert get_read_db(1, "FOOBAR") == "default"
+    assert get_read_db() == "replica"
+
+
+def queries(ctx):
+    return [q["sql"] for q in ctx.captured_queries]
+
+
+@pytest.mark.django_db(databases=["default", "replica"], transaction=True)
+def test_callback_queries_per_alias(env, client, replica):
+    event, order, payment = env
+    data = paygate_data(get_provider(payment), payment.full_id)
+
+    with CaptureQueriesContext(connections["default"]) as primary:
+        with CaptureQueriesContext(connections["replica"]) as secondary:
+            response = client.post(callback_url("notify", payment), {"Data": data})
+    assert response.status_code == 200
+
+    # The unlocked order lookup goes to the replica, nothing else does
+    replica_queries = queries(secondary)
+    assert len(replica_queries) == 1
+    assert replica_queries[0].startswith('SELECT "pretixbase_order"')
+    assert "FOOBAR" in replica_queries[0]
+
+    # The payment lookup, which locks on databases that support it, and all writes
+    # use the primary
+    primary_queries = queries(primary)
+    assert any(
+        q.startswith("SELECT") and 'FROM "pretixbase_orderpayment"' in q
+        for q in primary_queries
+    )
+    assert any(q.startswith('UPDATE "pretixbase_orderpayment"') for q in primary_queries)
+
+    # The order has just been written, the next lookup uses the primary. pretix
+    # itself may still resolve the event on the replica.
+    with CaptureQueriesContext(connections["replica"]) as secondary:
+        client.get(callback_url("status", payment))
+    assert not any('FROM "pretixbase_order"' in q for q in queries(secondary))
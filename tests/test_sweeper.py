@@ -0,0 +1,51 @@
+import pytest
+from datetime import timedelta
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import LogEntry, OrderPayment
+from unittest import mock
+
+from pretix_computop.sweeper import sweep_stale_payments
+
+
+@pytest.mark.django_db
+def test_sweep_cancels_and_logs(env):
+    event, order, payment = env
+    with scopes_disabled():
+        fresh = order.payments.create(
+            provider=payment.provider,
+            amount=payment.amount,
+            state=OrderPayment.PAYMENT_STATE_CREATED,
+        )
+        # Has received a callback
+        pending = order.payments.create(
+            provider=payment.provider,
+            amount=payment.amount,
+            state=OrderPayment.PAYMENT_STATE_PENDING,
+        )
+        OrderPayment.objects.filter(pk__in=[payment.pk, pending.pk]).update(
+            created=now() - timedelta(days=2)
+        )
+
+        with mock.patch.object(
+            LogEntry, "bulk_postprocess", wraps=LogEntry.bulk_postprocess
+        ) as postprocess:
+            swept, elapsed = sweep_stale_payments(timedelta(hours=24), batch_size=1)
+
+        assert swept == 1
+        payment.refresh_from_db()
+        fresh.refresh_from_db()
+        pending.refresh_from_db()
+        assert payment.state == OrderPayment.PAYMENT_STATE_CANCELED
+        assert "Payment process initiated" not in payment.info
+        assert fresh.state == OrderPayment.PAYMENT_STATE_CREATED
+        assert pending.state == OrderPayment.PAYMENT_STATE_PENDING
+        entry = order.all_logentries().get(
+            action_type="pretix.event.order.payment.canceled"
+        )
+        assert entry.parsed_data == {
+            "local_id": payment.local_id,
+            "provider": payment.provider,
+        }
+        # Notifications and webhooks are sent for the bulk created entries
+        postprocess.assert_called_once_with([entry])
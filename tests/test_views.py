@@ -0,0 +1,111 @@
+import pytest
+import threading
+from django.db import OperationalError, connection, transaction
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderPayment
+
+from pretix_computop.views import ComputopOrderView
+
+from .conftest import callback_url, get_provider, paygate_data
+
+
+class LockError(Exception):
+    pgcode = "55P03"
+
+
+def raise_operational_error(cause):
+    def get_payment_for_update(self):
+        try:
+            raise cause
+        except Exception as e:
+            raise OperationalError(str(e)) from e
+
+    return get_payment_for_update
+
+
+@pytest.mark.django_db
+def test_return_redirects_to_status_if_locked(env, client, monkeypatch):
+    event, order, payment = env
+    data = paygate_data(get_provider(payment), payment.full_id)
+    monkeypatch.setattr(
+        ComputopOrderView,
+        "get_payment_for_update",
+        raise_operational_error(LockError("could not obtain lock")),
+    )
+
+    response = client.post(callback_url("return", payment), {"Data": data})
+
+    assert response.status_code == 302
+    assert "/computop/status/" in response["Location"]
+
+
+@pytest.mark.django_db
+def test_return_reraises_other_database_errors(env, client, monkeypatch):
+    event, order, payment = env
+    data = paygate_data(get_provider(payment), payment.full_id)
+    monkeypatch.setattr(
+        ComputopOrderView,
+        "get_payment_for_update",
+        raise_operational_error(Exception("server closed the connection")),
+    )
+
+    with pytest.raises(OperationalError):
+        client.post(callback_url("return", payment), {"Data": data})
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.skipif(
+    connection.vendor != "postgresql", reason="NOWAIT needs a PostgreSQL database"
+)
+def test_return_concurrent_with_notify(env, client):
+    event, order, payment = env
+    data = paygate_data(get_provider(payment), payment.full_id)
+    locked = threading.Event()
+    release = threading.Event()
+
+    def hold_lock():
+        try:
+            with scopes_disabled(), transaction.atomic():
+                OrderPayment.objects.select_for_update().get(pk=payment.pk)
+                locked.set()
+                release.wait(10)
+        finally:
+            connection.close()
+
+    holder = threading.Thread(target=hold_lock)
+    holder.start()
+    try:
+        assert locked.wait(10)
+        response = client.post(callback_url("return", payment), {"Data": data})
+    finally:
+        release.set()
+        holder.join()
+
+    # The return view doesn't wait for the lock, it sends the customer to the
+    # status page and leaves the payment to whoever holds it.
+    assert response.status_code == 302
+    assert "/computop/status/" in response["Location"]
+    with scopes_disabled():
+        payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_CREATED
+
+    response = client.post(callback_url("return", payment), {"Data": data})
+    assert response.status_code == 302
+    with scopes_disabled():
+        payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+
+
+@pytest.mark.django_db
+def test_signed_notify_confirms_payment(env, client):
+    event, order, payment = env
+    data = paygate_data(get_provider(payment), payment.full_id)
+
+    response = client.post(callback_url("notify", payment), {"Data": data})
+
+    assert response.status_code == 200
+    with scopes_disabled():
+        payment.refresh_from_db()
+        order.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+    assert order.status == order.STATUS_PAID